@@ -2,6 +2,7 @@
 Contains python data structures
 """
 import datetime, logging
+from collections import OrderedDict
 from decimal import Decimal
 
 
@@ -73,6 +74,32 @@ class AttrDict(dict):
         super(AttrDict, self).__setattr__(name, value)
 D = AttrDict
 
+
+class LRUCache(OrderedDict):
+    """
+    Dictionary that holds at most max_size items.  Setting an item or getting
+    it with get() marks it as the most recently used, and when the cache is
+    full the least recently used item is dropped.
+    """
+
+    def __init__(self, max_size=1000, *args, **kwargs):
+        self.max_size = max_size
+        super(LRUCache, self).__init__(*args, **kwargs)
+
+    def __setitem__(self, key, value):
+        if key in self:
+            del self[key]
+        elif self.max_size and len(self) >= self.max_size:
+            self.popitem(last=False)
+        super(LRUCache, self).__setitem__(key, value)
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        value = self.pop(key)
+        super(LRUCache, self).__setitem__(key, value)
+        return value
+
 class DataTable(object):
 
     class DataColumn(AttrDict):
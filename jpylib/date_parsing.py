@@ -0,0 +1,115 @@
+"""
+Contains fast date and datetime parsing methods.  The common fixed-width
+formats (ISO-8601, Facebook and Twitter) are parsed by slicing the string,
+and datetime.strptime is only used for other formats or values that
+don't fit the fixed positions.  Parsed values are memoized, since the
+same timestamps tend to repeat throughout an import.
+"""
+import datetime
+
+
+ISO_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+ISO_DATE_FORMAT = '%Y-%m-%d'
+FACEBOOK_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S+0000'
+TWITTER_DATETIME_FORMAT = '%a %b %d %H:%M:%S +0000 %Y'
+
+# Max number of parsed values to keep.  The memo is cleared once it's full.
+MEMO_SIZE = 10000
+
+_memo = {}
+
+_MONTHS = dict((m, i + 1) for i, m in enumerate(
+    ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+))
+_WEEKDAYS = frozenset(['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun'])
+
+
+def _parse_iso_datetime(value):
+    if (len(value) == 19 and value[4] == '-' and value[7] == '-' and value[10] == 'T'
+            and value[13] == ':' and value[16] == ':'
+            and (value[0:4] + value[5:7] + value[8:10] +
+                 value[11:13] + value[14:16] + value[17:19]).isdigit()):
+        return datetime.datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                                 int(value[11:13]), int(value[14:16]), int(value[17:19]))
+    return None
+
+
+def _parse_iso_date(value):
+    if (len(value) == 10 and value[4] == '-' and value[7] == '-'
+            and (value[0:4] + value[5:7] + value[8:10]).isdigit()):
+        return datetime.datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+    return None
+
+
+def _parse_facebook_datetime(value):
+    if len(value) == 24 and value[19:] == '+0000':
+        return _parse_iso_datetime(value[:19])
+    return None
+
+
+def _parse_twitter_datetime(value):
+    # Fixed positions of 'Wed Aug 27 13:08:45 +0000 2008'
+    if (len(value) == 30 and value[3] == ' ' and value[7] == ' ' and value[10] == ' '
+            and value[13] == ':' and value[16] == ':' and value[19:26] == ' +0000 '
+            and value[0:3].lower() in _WEEKDAYS and value[4:7].lower() in _MONTHS
+            and (value[8:10] + value[11:13] + value[14:16] +
+                 value[17:19] + value[26:30]).isdigit()):
+        return datetime.datetime(int(value[26:30]), _MONTHS[value[4:7].lower()],
+                                 int(value[8:10]), int(value[11:13]),
+                                 int(value[14:16]), int(value[17:19]))
+    return None
+
+
+_FAST_PARSERS = {
+    ISO_DATETIME_FORMAT: _parse_iso_datetime,
+    ISO_DATE_FORMAT: _parse_iso_date,
+    FACEBOOK_DATETIME_FORMAT: _parse_facebook_datetime,
+    TWITTER_DATETIME_FORMAT: _parse_twitter_datetime,
+}
+
+
+def parse_datetime(value, format=ISO_DATETIME_FORMAT):
+    """
+    Parses the string into a datetime, the same as datetime.strptime.
+    Raises ValueError if the value doesn't match the format.
+
+    :param value: The string to parse
+    :param format: The strptime format of the string
+    :return: The parsed datetime
+
+    >>> parse_datetime('2014-03-01T12:30:05')
+    datetime.datetime(2014, 3, 1, 12, 30, 5)
+    >>> parse_datetime('2014-03-01', ISO_DATE_FORMAT)
+    datetime.datetime(2014, 3, 1, 0, 0)
+    >>> parse_datetime('Sat Mar 01 12:30:05 +0000 2014', TWITTER_DATETIME_FORMAT)
+    datetime.datetime(2014, 3, 1, 12, 30, 5)
+    >>> parse_datetime('01/03/2014', '%d/%m/%Y')
+    datetime.datetime(2014, 3, 1, 0, 0)
+    """
+    key = (value, format)
+    try:
+        return _memo[key]
+    except KeyError:
+        pass
+
+    fast_parser = _FAST_PARSERS.get(format)
+    parsed = fast_parser(value) if fast_parser else None
+    if parsed is None:
+        parsed = datetime.datetime.strptime(value, format)
+
+    if len(_memo) >= MEMO_SIZE:
+        _memo.clear()
+    _memo[key] = parsed
+
+    return parsed
+
+
+def parse_date(value, format=ISO_DATE_FORMAT):
+    """
+    Parses the string into a datetime at midnight, the same as
+    datetime.strptime with a date format.
+
+    >>> parse_date('2014-03-01')
+    datetime.datetime(2014, 3, 1, 0, 0)
+    """
+    return parse_datetime(value, format)
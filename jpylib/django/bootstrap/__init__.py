@@ -3,18 +3,46 @@ Contains utilities used when booting up Django.  bootstrap() method
 should be called when application boots up.  App-level folders will
 have their bootstrap python modules/packages loaded.  Environment
 variables and PYTHONPATH are set up. Other misc services are initialized.
+
+Set BOOTSTRAP_PROFILE_IMPORTS=1 (or true, yes, on) in the environment to
+log a tree of the time spent importing each module during startup.
 """
+import hashlib
+import json
+import logging
 import os
+import time
+
+from .imports import *
+
+if os.environ.get('BOOTSTRAP_PROFILE_IMPORTS', '').strip().lower() in ('1', 'true', 'yes', 'on'):
+    # Started before importing Django, so its imports are included
+    start_import_profiler()
 
 from django.core.wsgi import get_wsgi_application
 from django.utils.importlib import import_module
 from django.utils.module_loading import module_has_submodule
 
+from jpylib.private_files import check_private_dir, get_private_dir, write_atomic
+
 from .exceptions import *
 from .path import *
 from . import plugins
 
 
+logger = logging.getLogger(__name__)
+
+# Directory the discovered app submodules are cached in by load_app_modules.
+# It's private to the user, since the cache decides which modules are imported.
+APP_MODULES_CACHE_DIR = os.environ.get('BOOTSTRAP_CACHE_DIR') or get_private_dir()
+
+# Plugins that load_plugins can defer, to the module whose first import loads them
+LAZY_PLUGIN_TRIGGERS = {
+    'celery_plugin': 'celery',
+    'mongoengine_plugin': 'mongoengine',
+}
+
+
 def define_settings_module_env(settings_namespace=None, env_var=None):
     """
     Sets the DJANGO_SETTINGS_MODULE to the environment variable value if specified,
@@ -49,7 +77,12 @@ def bootstrap_wsgi():
     """
     Used to get and bootstrap the Django WSGI application
     """
-    return get_wsgi_application()
+    start = time.time()
+    application = get_wsgi_application()
+    logger.info("Process %s loaded the WSGI application in %.0fms",
+                os.getpid(), (time.time() - start) * 1000)
+    report_import_profile()
+    return application
 
 
 def import_submodule(module, package, submodule):
@@ -63,6 +96,7 @@ def import_submodule(module, package, submodule):
     :type app: string
     :param submodule: the submodule we're loading form the app
     :type sudmodule: string
+    :returns: True if the submodule was loaded, False if it doesn't exist
     """
     # noinspection PyBroadException
     try:
@@ -70,34 +104,128 @@ def import_submodule(module, package, submodule):
     except:
         if module_has_submodule(module, submodule):
             raise
+        return False
+    return True
+
+
+def get_app_modules_cache_path(apps, cache_dir=None):
+    """
+    Gets the path of the app submodules cache for the installed apps of
+    the project in DJANGO_PROJECT_ROOT
+
+    :param apps: List of apps the submodules are loaded from
+    :type apps: list of strings
+    :param cache_dir: The directory of the cache. Defaults to APP_MODULES_CACHE_DIR
+    :type cache_dir: string
+    """
+    key = hashlib.md5('\n'.join([os.environ.get('DJANGO_PROJECT_ROOT', '')] + list(apps))).hexdigest()
+    return os.path.join(cache_dir or APP_MODULES_CACHE_DIR, 'jpylib-app-modules-{}.json'.format(key))
+
+
+def _package_mtime(module):
+    """
+    Gets the mtime of the app's package directory, which changes when
+    submodules are added or removed.  None if the app isn't a package.
+    """
+    path = getattr(module, '__path__', None)
+    return os.path.getmtime(path[0]) if path else None
 
 
-def load_app_modules(apps, submodules):
+def _read_app_modules_cache(path):
+    try:
+        with open(path) as cache_file:
+            return json.load(cache_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_app_modules_cache(path, cache):
+    try:
+        write_atomic(path, json.dumps(cache))
+    except (IOError, OSError):
+        logger.warning("Could not write the app modules cache to %s", path)
+
+
+def load_app_modules(apps, submodules, use_cache=True, cache_dir=None):
     """
     This code was taken from the Pinax project.  It will initialize
     submodules for all the installed apps if they match the given
     strings in the submodules list.
 
+    Which submodules each app has is cached to disk, so submodules known
+    to be missing aren't probed for again.  An app's entry is thrown out
+    when its package directory's mtime changes.
+
     :param apps: List of apps to load the submodules from
     :type apps: list of strings representing django apps
     :param submodules: List of submodules from :setting:`INSTALLED_APPS` to load
     :type submodules: list of strings representing app modules
+    :param use_cache: Set to False to probe for every submodule
+    :type use_cache: bool
+    :param cache_dir: The directory of the cache. Defaults to APP_MODULES_CACHE_DIR
+    :type cache_dir: string
     """
+    start = time.time()
+    cache_path = get_app_modules_cache_path(apps, cache_dir)
+    use_cache = use_cache and check_private_dir(os.path.dirname(cache_path))
+    cache = _read_app_modules_cache(cache_path) if use_cache else {}
+    probed = 0
+
     for app in apps:
         mod = import_module(app)
+        mtime = _package_mtime(mod)
+
+        entry = cache.get(app)
+        if entry is None or entry['mtime'] != mtime:
+            entry = cache[app] = {'mtime': mtime, 'submodules': {}}
+        found = entry['submodules']
+
+        app_probed = probed
         for submodule in submodules:
-            import_submodule(mod, app, submodule)
+            if found.get(submodule) is False:
+                continue
+            if submodule not in found:
+                probed += 1
+            found[submodule] = import_submodule(mod, app, submodule)
+
+        if probed > app_probed:
+            # Loading can write .pyc files, which changes the directory's mtime
+            entry['mtime'] = _package_mtime(mod)
+
+    if use_cache and probed:
+        _write_app_modules_cache(cache_path, cache)
+
+    logger.info("Process %s loaded the %s submodules of %s apps in %.0fms (%s probed)",
+                os.getpid(), ', '.join(submodules), len(apps),
+                (time.time() - start) * 1000, probed)
 
 
-def load_plugins(plugin_list):
+def load_plugins(plugin_list, lazy=False):
     """
     Loads the given plugins from the plugins folder.  Ensure this
     is called after we can load the settings.  Essentially,
     DJANGO_SETTINGS_MODULE needs to be set.
 
+    With lazy, the plugins in LAZY_PLUGIN_TRIGGERS aren't loaded until
+    the module they set up is first imported, so processes that never
+    use celery or mongoengine don't pay for setting them up.
+
     :param plugin_list: List of plugins to load
     :type plugin_list: list of strings
+    :param lazy: Set to defer the plugins that can be deferred
+    :type lazy: bool
     """
     for plugin in plugin_list:
-        import_submodule(plugins, 'project.django.bootstrap.plugins', plugin)
+        trigger = LAZY_PLUGIN_TRIGGERS.get(plugin) if lazy else None
+        if trigger:
+            lazy_plugins.register(trigger, _plugin_loader(plugin))
+        else:
+            import_submodule(plugins, 'project.django.bootstrap.plugins', plugin)
 
+
+def _plugin_loader(plugin):
+    def load_plugin():
+        start = time.time()
+        import_submodule(plugins, 'project.django.bootstrap.plugins', plugin)
+        logger.info("Loaded deferred plugin %s in %.0fms", plugin, (time.time() - start) * 1000)
+    return load_plugin
@@ -0,0 +1,179 @@
+"""
+Contains utilities for profiling and deferring the imports done while
+bootstrapping.  ImportProfiler records how long each import took as a
+tree of the imports it triggered.  LazyPluginFinder defers loading a
+plugin until the module it sets up is first imported.
+"""
+import __builtin__
+import atexit
+import logging
+import sys
+import time
+
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['ImportProfiler', 'LazyPluginFinder', 'lazy_plugins',
+           'start_import_profiler', 'report_import_profile']
+
+
+class ImportNode(object):
+    """
+    An import in the ImportProfiler tree
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.elapsed = 0.0
+        self.children = []
+
+    @property
+    def self_time(self):
+        return self.elapsed - sum(child.elapsed for child in self.children)
+
+    def format(self, min_time, depth=0):
+        """
+        Formats this import and the ones it triggered, slowest first
+
+        :param min_time: Imports that took less seconds than this are left out
+        :type min_time: float
+        :returns: list of lines
+        """
+        lines = ['{:>9.1f}ms {:>9.1f}ms  {}{}'.format(self.elapsed * 1000, self.self_time * 1000,
+                                                     '  ' * depth, self.name)]
+        for child in sorted(self.children, key=lambda node: node.elapsed, reverse=True):
+            if child.elapsed >= min_time:
+                lines.extend(child.format(min_time, depth + 1))
+        return lines
+
+
+class ImportProfiler(object):
+    """
+    Times every import that loads a new module by wrapping __import__.
+    Imports of modules that are already loaded are left out of the tree.
+    Only meant for startup, since imports from other threads would be
+    nested under whatever the main thread is importing.
+    """
+
+    def __init__(self):
+        self.root = ImportNode('<startup>')
+        self.running = False
+        self._stack = [self.root]
+        self._original_import = None
+        self._start = None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self._start = time.time()
+        self._original_import = __builtin__.__import__
+        __builtin__.__import__ = self._import
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        __builtin__.__import__ = self._original_import
+        self.root.elapsed = time.time() - self._start
+
+    def _import(self, name, globals=None, locals=None, fromlist=None, level=-1):
+        modules = len(sys.modules)
+        parent = self._stack[-1]
+        node = ImportNode('.' * level + name if level > 0 else name)
+        parent.children.append(node)
+        self._stack.append(node)
+
+        start = time.time()
+        try:
+            return self._original_import(name, globals, locals, fromlist, level)
+        finally:
+            node.elapsed = time.time() - start
+            self._stack.pop()
+            if len(sys.modules) == modules:
+                # Nothing new was loaded
+                parent.children.remove(node)
+
+    def format(self, min_ms=1.0):
+        """
+        Formats the import tree
+
+        :param min_ms: Imports faster than this many ms are left out
+        :type min_ms: float
+        :returns: string
+        """
+        header = '{:>11} {:>11}  {}'.format('total', 'self', 'module')
+        return '\n'.join([header] + self.root.format(min_ms / 1000.0))
+
+
+import_profiler = None
+
+
+def start_import_profiler():
+    """
+    Starts profiling the imports.  The tree is logged by report_import_profile,
+    which bootstrap_wsgi calls once the application is loaded, or at exit.
+    """
+    global import_profiler
+    if import_profiler is None:
+        import_profiler = ImportProfiler()
+        import_profiler.start()
+        atexit.register(report_import_profile)
+
+
+def report_import_profile(min_ms=1.0):
+    """
+    Stops the import profiler, if it was started, and logs the import tree
+    """
+    if import_profiler is not None and import_profiler.running:
+        import_profiler.stop()
+        logger.info("Startup imports:\n%s", import_profiler.format(min_ms))
+
+
+class LazyPluginFinder(object):
+    """
+    Import hook that runs callbacks when a module is first imported, used
+    to defer a plugin until the module it sets up is actually used.
+    """
+
+    def __init__(self):
+        # Module name to the callbacks waiting on its import
+        self.triggers = {}
+
+    def register(self, module_name, callback):
+        """
+        Calls the callback once the module is imported, or right away if it
+        already was
+
+        :param module_name: The full name of the module
+        :type module_name: string
+        :param callback: Called with no arguments
+        :type callback: callable
+        """
+        if module_name in sys.modules:
+            callback()
+            return
+
+        self.triggers.setdefault(module_name, []).append(callback)
+        if self not in sys.meta_path:
+            sys.meta_path.insert(0, self)
+
+    def find_module(self, fullname, path=None):
+        return self if fullname in self.triggers else None
+
+    def load_module(self, fullname):
+        callbacks = self.triggers.pop(fullname)
+        if not self.triggers and self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+        # Import it the normal way, now that this finder won't claim it
+        __import__(fullname)
+        module = sys.modules[fullname]
+
+        for callback in callbacks:
+            callback()
+
+        return module
+
+
+lazy_plugins = LazyPluginFinder()
@@ -4,6 +4,9 @@ MONGO_DATABASES setting available.  Should be in the same format
 as the Django DATABASES, with the keys being the db name and
 the values being passed to connect as kwargs.  If using more than
 one DB, ensure that the alias is set in the values.
+
+If MONGO_LAZY_CONNECT is True, the connections are only registered,
+and mongoengine connects when a connection is first used.
 """
 
 from django.conf import settings
@@ -15,8 +18,15 @@ if dbs:
     # initialize the connections to them so this won't need to
     # be done manually later.
     from mongoengine import connect
+    from mongoengine.connection import DEFAULT_CONNECTION_NAME, register_connection
+
+    lazy = getattr(settings, 'MONGO_LAZY_CONNECT', False)
     for db, kwargs in dbs.iteritems():
-        connect(db, **kwargs)
+        if lazy:
+            kwargs = dict(kwargs)
+            register_connection(kwargs.pop('alias', DEFAULT_CONNECTION_NAME), db, **kwargs)
+        else:
+            connect(db, **kwargs)
 
 else:
     print "No MONGO_DATABASES setting found.  Mongo is not instantiated!"
@@ -3,15 +3,37 @@ Contains a plugin that can be loaded up with Django
 the instantiates a signal that can enter a pdb session.
 If we're debugging, it will also override the sys.excepthook
 to allow for an interactive debugger.
+
+Production workers have no TTY for the console, so when PDB_SIGNAL_PROFILER
+is set to True the signals control a sampling profiler instead.  SIGUSR1
+starts the profiler, and the next SIGUSR1 stops it and writes the stacks
+sampled across all threads and greenlets to PDB_PROFILE_DIR in collapsed
+stack format, ready for flamegraph.pl or speedscope.  SIGUSR2 writes the
+stacks sampled so far without stopping.  PDB_PROFILE_DIR defaults to
+~/.cache/jpylib/profiles, and profiles aren't written to a directory
+other users can write to.
 """
 import code
+import logging
+import os
 import pdb
 import signal
 import sys
+import time
 import traceback
 
 from django.conf import settings
 
+from jpylib.private_files import check_private_dir, get_private_dir
+from jpylib.profiling import SamplingProfiler
+
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = getattr(settings, 'PDB_PROFILE_DIR', get_private_dir('profiles'))
+
+profiler = SamplingProfiler(interval=getattr(settings, 'PDB_PROFILE_INTERVAL', 0.005))
+
 
 def except_hook(type, value, tb):
     """
@@ -57,8 +79,52 @@ def signal_hook(sig, frame):
         message += ''.join(traceback.format_stack(frame))
         i.interact(message)
 
-# Hook our signal hook up to listen for the SIGUSR1 signal
-signal.signal(signal.SIGUSR1, signal_hook)
+
+def dump_profile():
+    """
+    Writes the profiler's sampled stacks to a file in PDB_PROFILE_DIR
+
+    :returns: The path of the file, or None if PDB_PROFILE_DIR can't be used
+    """
+    if not check_private_dir(PROFILE_DIR):
+        return None
+
+    path = os.path.join(PROFILE_DIR, 'profile-{}-{}.collapsed'.format(os.getpid(), int(time.time() * 1000)))
+    profiler.dump(path)
+    logger.warning("Wrote %s profiler samples to %s", profiler.samples, path)
+    return path
+
+
+def profile_toggle_hook(sig, frame):
+    """
+    Hooks into a SIGUSR1 signal to start the sampling profiler,
+    or stop it and write out its samples if it's running
+    """
+    if profiler.running:
+        profiler.stop()
+        dump_profile()
+        profiler.reset()
+    else:
+        logger.warning("Starting the sampling profiler in process %s", os.getpid())
+        profiler.start()
+
+
+def profile_dump_hook(sig, frame):
+    """
+    Hooks into a SIGUSR2 signal to write out the samples so far,
+    leaving the profiler running
+    """
+    if profiler.samples:
+        dump_profile()
+
+
+if getattr(settings, 'PDB_SIGNAL_PROFILER', False):
+    # Without a TTY, use the signals for the sampling profiler
+    signal.signal(signal.SIGUSR1, profile_toggle_hook)
+    signal.signal(signal.SIGUSR2, profile_dump_hook)
+else:
+    # Hook our signal hook up to listen for the SIGUSR1 signal
+    signal.signal(signal.SIGUSR1, signal_hook)
 
 if settings.DEBUG and getattr(settings, 'PDB_DEBUG', True):
     # If we're debugging and we're allowing PDB, set exception hook
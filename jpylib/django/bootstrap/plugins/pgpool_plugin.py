@@ -0,0 +1,288 @@
+"""
+Bootstrap plugin that pools the Postgres connections of Django's
+postgresql_psycopg2 backend.  With gevent and psycogreen, every greenlet
+gets its own DatabaseWrapper, and without the pool every concurrent
+request opens a new Postgres connection.  With the pool, closing the
+DatabaseWrapper hands its connection back to the pool instead.
+
+Load it after the gevent and psycogreen plugins:
+
+    load_plugins(['gevent_plugin', 'psycogreen_plugin', 'pgpool_plugin'])
+
+Each database can set its pool up with a POOL dict in DATABASES:
+
+    'POOL': {
+        'MAX_SIZE': 10,         # Most connections open at once
+        'MAX_IDLE': 300,        # Seconds before an idle connection is closed
+        'WAIT_TIMEOUT': 30,     # Seconds to wait for a free connection
+        'CHECK_AFTER': 30,      # Seconds idle before a connection is pinged on checkout
+    }
+
+Set ENABLE_DB_POOL=0 in the environment to disable the pool.
+"""
+import logging
+import os
+import time
+
+from django.conf import settings
+from django.db import DatabaseError
+from gevent.lock import BoundedSemaphore
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SETTINGS = {
+    'MAX_SIZE': 10,
+    'MAX_IDLE': 300,
+    'WAIT_TIMEOUT': 30,
+    'CHECK_AFTER': 30,
+}
+
+
+class PoolTimeout(DatabaseError):
+    """
+    Raised when no connection became free within the pool's wait timeout
+    """
+    pass
+
+
+class ConnectionPool(object):
+    """
+    A bounded pool of psycopg2 connections for one database.  Greenlets
+    wait on a semaphore for one of the max_size slots.  Idle connections
+    are reused most recently returned first, so the least used ones age
+    out and get closed.
+    """
+
+    def __init__(self, alias, max_size=10, max_idle=300, wait_timeout=30, check_after=30):
+        """
+        :param alias: The alias of the database in DATABASES
+        :type alias: string
+        :param max_size: The most connections open at once
+        :type max_size: int
+        :param max_idle: Seconds before an idle connection is closed
+        :type max_idle: int
+        :param wait_timeout: Seconds to wait for a free connection
+        :type wait_timeout: int
+        :param check_after: Seconds idle before a connection is pinged on checkout
+        :type check_after: int
+        """
+        self.alias = alias
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.wait_timeout = wait_timeout
+        self.check_after = check_after
+
+        self.slots = BoundedSemaphore(max_size)
+        # (connection, time returned), most recently returned last
+        self.idle = []
+
+    def checkout(self):
+        """
+        Takes a slot in the pool and an idle connection for it
+
+        :raises: PoolTimeout
+        :returns: The connection, or None if a new connection should be opened for the slot
+        """
+        if not self.slots.acquire(timeout=self.wait_timeout):
+            raise PoolTimeout("No connection to database '{}' became free within {} seconds.".format(
+                self.alias, self.wait_timeout))
+
+        try:
+            while self.idle:
+                connection, returned_at = self.idle.pop()
+                if self.is_usable(connection, returned_at):
+                    return connection
+                self.discard(connection)
+        except:
+            self.slots.release()
+            raise
+
+        return None
+
+    def checkin(self, connection):
+        """
+        Returns the connection to the pool and frees its slot
+        """
+        try:
+            if self.reset(connection):
+                self.idle.append((connection, time.time()))
+            else:
+                self.discard(connection)
+        finally:
+            self.slots.release()
+
+        self.evict_idle()
+
+    def release(self):
+        """
+        Frees a slot that didn't end up with a connection
+        """
+        self.slots.release()
+
+    def is_usable(self, connection, returned_at):
+        import psycopg2
+
+        if connection.closed:
+            return False
+
+        idle_for = time.time() - returned_at
+        if idle_for > self.max_idle:
+            return False
+
+        if idle_for > self.check_after:
+            try:
+                cursor = connection.cursor()
+                cursor.execute('SELECT 1')
+                cursor.close()
+                connection.rollback()
+            except psycopg2.Error:
+                return False
+
+        return True
+
+    def reset(self, connection):
+        """
+        Rolls back anything left open on the connection
+
+        :returns: True if the connection can be reused
+        """
+        import psycopg2
+        from psycopg2 import extensions
+
+        if connection.closed:
+            return False
+
+        try:
+            status = connection.get_transaction_status()
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                return False
+            if status != extensions.TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+        except psycopg2.Error:
+            return False
+
+        return True
+
+    def discard(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            logger.debug("Error closing discarded connection to database '%s'.",
+                         self.alias, exc_info=True)
+
+    def evict_idle(self):
+        """
+        Closes the connections that have been idle longer than max_idle
+        """
+        now = time.time()
+        while self.idle and now - self.idle[0][1] > self.max_idle:
+            self.discard(self.idle.pop(0)[0])
+
+
+pools = {}
+
+
+def get_pool(alias):
+    """
+    Gets the pool for the database alias, creating it the first time.
+    Pools are created on first use, so forked workers never share one.
+    """
+    pool = pools.get(alias)
+    if pool is None:
+        options = dict(DEFAULT_POOL_SETTINGS)
+        options.update(settings.DATABASES[alias].get('POOL', {}))
+        pool = pools[alias] = ConnectionPool(alias,
+                                             max_size=options['MAX_SIZE'],
+                                             max_idle=options['MAX_IDLE'],
+                                             wait_timeout=options['WAIT_TIMEOUT'],
+                                             check_after=options['CHECK_AFTER'])
+    return pool
+
+
+def _in_transaction_block(wrapper):
+    """
+    Checks if Django has a transaction open on the wrapper, in an atomic
+    block or, before Django 1.6, under transaction management
+    """
+    return getattr(wrapper, 'in_atomic_block', False) or bool(getattr(wrapper, 'transaction_state', None))
+
+
+def _reset_wrapper_state(wrapper):
+    """
+    Puts a connection from the pool in the autocommit mode the wrapper
+    expects, since Django only sets it when it opens a new connection
+    """
+    if hasattr(wrapper, 'set_autocommit'):
+        # Django 1.6+ tracks autocommit on the wrapper
+        wrapper.set_autocommit(wrapper.settings_dict['AUTOCOMMIT'])
+    else:
+        wrapper.connection.set_isolation_level(wrapper.isolation_level)
+
+
+def install():
+    """
+    Patches the postgresql_psycopg2 DatabaseWrapper to get its connections
+    from the pool and return them on close.  Connections are rolled back
+    when they're returned, and put back in the wrapper's autocommit mode
+    when they're taken.  A connection closed while Django still has a
+    transaction open on it is closed instead of being returned.
+    """
+    from django.db.backends.postgresql_psycopg2.base import DatabaseWrapper
+
+    if getattr(DatabaseWrapper, '_pool_installed', False):
+        return
+
+    original_cursor = DatabaseWrapper._cursor
+
+    def _cursor(self):
+        if self.connection is None:
+            pool = get_pool(self.alias)
+            self.connection = pool.checkout()
+            if self.connection is None:
+                # A slot but no idle connection, let Django open and set up a new one
+                try:
+                    return original_cursor(self)
+                except:
+                    if self.connection is not None:
+                        pool.discard(self.connection)
+                        self.connection = None
+                    pool.release()
+                    raise
+
+            try:
+                _reset_wrapper_state(self)
+            except:
+                connection, self.connection = self.connection, None
+                pool.discard(connection)
+                pool.release()
+                raise
+        return original_cursor(self)
+
+    def close(self):
+        self.validate_thread_sharing()
+        if self.connection is None:
+            return
+
+        connection, self.connection = self.connection, None
+        pool = get_pool(self.alias)
+        if _in_transaction_block(self):
+            # Another wrapper can't be handed a connection that's in the middle
+            # of this one's transaction, so close it, which rolls it back
+            if getattr(self, 'in_atomic_block', False):
+                # Like Django's close(), so the atomic block knows it was lost
+                self.closed_in_transaction = True
+                self.needs_rollback = True
+            pool.discard(connection)
+            pool.release()
+        else:
+            pool.checkin(connection)
+
+    DatabaseWrapper._cursor = _cursor
+    DatabaseWrapper.close = close
+    DatabaseWrapper._pool_installed = True
+
+
+if int(os.environ.get('ENABLE_DB_POOL', '1')):
+    # Disable the pool if it's disabled in the environment
+    install()
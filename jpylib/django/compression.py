@@ -0,0 +1,116 @@
+"""
+Contains helpers for compressing response bodies in-process, either all
+at once or chunk by chunk for streaming responses.  gzip is always
+available, brotli is used if the brotli module is installed.
+"""
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+GZIP = 'gzip'
+BROTLI = 'br'
+
+# Levels that give most of the size savings on JSON for a fraction of the CPU
+DEFAULT_GZIP_LEVEL = 6
+DEFAULT_BROTLI_QUALITY = 4
+
+
+def available_encodings():
+    """
+    Gets the encodings that can be used, in order of preference
+    """
+    return (BROTLI, GZIP) if brotli is not None else (GZIP,)
+
+
+def parse_accept_encoding(header):
+    """
+    Parses an Accept-Encoding header into a dict of encoding to its q value
+
+    >>> sorted(parse_accept_encoding('gzip, br;q=0.5, identity;q=0').items())
+    [('br', 0.5), ('gzip', 1.0), ('identity', 0.0)]
+    """
+    encodings = {}
+    for item in header.split(','):
+        encoding, _, params = item.partition(';')
+        encoding = encoding.strip().lower()
+        if not encoding:
+            continue
+
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        encodings[encoding] = q
+    return encodings
+
+
+def choose_encoding(header, encodings=None):
+    """
+    Chooses the encoding to compress with for the Accept-Encoding header
+
+    :param header: The value of the request's Accept-Encoding header
+    :type header: string
+    :param encodings: The encodings we allow, in order of preference.
+                      Defaults to available_encodings()
+    :returns: The encoding, or None if the response shouldn't be compressed
+    """
+    accepted = parse_accept_encoding(header or '')
+    for encoding in encodings or available_encodings():
+        if encoding == BROTLI and brotli is None:
+            continue
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def _compressor(encoding, level):
+    if encoding == BROTLI:
+        compressor = brotli.Compressor(quality=level if level is not None else DEFAULT_BROTLI_QUALITY)
+        return compressor.process, compressor.finish
+
+    # wbits of 16 + MAX_WBITS gives the gzip header and trailer
+    compressor = zlib.compressobj(level if level is not None else DEFAULT_GZIP_LEVEL,
+                                  zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress, compressor.flush
+
+
+def compress(content, encoding, level=None):
+    """
+    Compresses the whole content
+
+    :param content: The bytes to compress
+    :param encoding: GZIP or BROTLI
+    :param level: The gzip level or brotli quality. Defaults to a level tuned for JSON
+    :returns: The compressed bytes
+    """
+    process, finish = _compressor(encoding, level)
+    return process(content) + finish()
+
+
+def compress_iter(iterable, encoding, level=None):
+    """
+    Compresses the fragments of the iterable as they are read.  Compressed
+    data is yielded whenever the compressor has some ready, so the
+    uncompressed body is never held in memory all at once.
+
+    :param iterable: Iterable of byte strings to compress
+    :param encoding: GZIP or BROTLI
+    :param level: The gzip level or brotli quality. Defaults to a level tuned for JSON
+    :returns: generator of compressed byte strings
+    """
+    process, finish = _compressor(encoding, level)
+    for fragment in iterable:
+        if isinstance(fragment, unicode):
+            fragment = fragment.encode('utf-8')
+        data = process(fragment)
+        if data:
+            yield data
+    yield finish()
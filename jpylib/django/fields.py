@@ -1,7 +1,8 @@
 from django.db import models
 from django.utils import simplejson
 
-from datetime import datetime
+from jpylib.date_parsing import (parse_datetime, ISO_DATETIME_FORMAT,
+                                  FACEBOOK_DATETIME_FORMAT, TWITTER_DATETIME_FORMAT)
 
 class JSONDictField(models.TextField):
     def to_python(self, value):
@@ -22,8 +23,8 @@ class JSONListField(models.TextField):
     def get_db_prep_save(self, value, connection):
         return simplejson.dumps(value)
     
-FACEBOOK_DATEFORMAT = '%Y-%m-%dT%H:%M:%S+0000'
-FACEBOOK_FALLBACK_DATEFORMAT = '%Y-%m-%dT%H:%M:%S'
+FACEBOOK_DATEFORMAT = FACEBOOK_DATETIME_FORMAT
+FACEBOOK_FALLBACK_DATEFORMAT = ISO_DATETIME_FORMAT
 
 class FBDateField(models.DateTimeField):
     """ Datetime field that can be assigned dates in the format
@@ -39,9 +40,9 @@ class FBDateField(models.DateTimeField):
         """
         if isinstance(value, basestring):
             try:
-                return datetime.strptime(value, FACEBOOK_DATEFORMAT)
+                return parse_datetime(value, FACEBOOK_DATEFORMAT)
             except ValueError:
-                return datetime.strptime(value[:19], FACEBOOK_FALLBACK_DATEFORMAT)
+                return parse_datetime(value[:19], FACEBOOK_FALLBACK_DATEFORMAT)
         return super(FBDateField, self).to_python(value)
 
     def get_db_prep_save(self, value,connection):
@@ -57,7 +58,7 @@ class FBDateField(models.DateTimeField):
         """
         return super(FBDateField, self).get_db_prep_save(self.to_python(value), connection)
     
-Twitter_DATEFORMAT = '%a %b %d %H:%M:%S +0000 %Y'
+Twitter_DATEFORMAT = TWITTER_DATETIME_FORMAT
 
 class TWDateField(models.DateTimeField):
     """ Datetime field that can be assigned dates in the format
@@ -73,7 +74,7 @@ class TWDateField(models.DateTimeField):
         """
         if isinstance(value, basestring):
             try:
-                return datetime.strptime(value, Twitter_DATEFORMAT)
+                return parse_datetime(value, Twitter_DATEFORMAT)
             except ValueError:
                 pass
         return super(TWDateField, self).to_python(value)
@@ -0,0 +1,684 @@
+"""
+Contains a pre-fork master that runs gevent WSGI workers.  The master binds
+the listening socket once, forks the workers, respawns workers that die,
+and drains them on shutdown.  Used by the run_gevent management command.
+
+Signals handled by the master:
+    TERM:       Graceful shutdown. Workers stop accepting and finish their
+                requests, up to the graceful timeout.
+    INT, QUIT:  Quick shutdown.
+    HUP:        Rolling restart. Each worker is replaced by a new one, and
+                only stopped once its replacement is accepting connections.
+
+Workers can also be recycled after a number of requests, once their RSS
+grows past a limit, or after a maximum age.  Each worker adds random
+jitter to its thresholds so they don't all recycle at once.  A worker
+that hits a threshold asks the master to replace it, and keeps serving
+until its replacement is accepting connections.
+
+Each worker handles at most worker_connections connections at once.
+Past that, connections wait in the listen backlog.  With shed_load, a
+worker accepts a few connections past the limit and answers them with
+a fast 503, instead of letting the backlog turn into a latency collapse.
+
+With reuse_port, the master doesn't share a listening socket.  Each
+worker binds its own socket with SO_REUSEPORT and the kernel balances
+the connections across them, instead of all the workers waking up to
+accept on one socket.  Note that connections still in a stopping
+worker's backlog are reset when it closes its socket.  With
+cpu_affinity, each worker is pinned to a CPU by its slot number.
+"""
+import errno
+import logging
+import os
+import random
+import resource
+import select
+import signal
+import socket
+import sys
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+logger = logging.getLogger(__name__)
+
+# Messages sent from the workers to the master over their pipe
+WORKER_READY = 'R'
+WORKER_RECYCLE = 'X'
+
+# Python 2's socket module doesn't define SO_REUSEPORT
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15 if sys.platform.startswith('linux') else None)
+
+
+class WorkerProcess(object):
+    """
+    The master's record of a forked worker
+    """
+
+    def __init__(self, pid, pipe, index, replaces=None):
+        self.pid = pid
+        self.pipe = pipe
+        # The worker's slot, used for its CPU affinity
+        self.index = index
+        self.started = time.time()
+        self.ready = False
+        self.retiring = False
+        self.retired_at = None
+        self.recycling = False
+        # pid of the worker this one is replacing, until this one is ready
+        self.replaces = replaces
+
+
+class PreforkMaster(object):
+    """
+    Binds the listening socket and supervises the gevent workers serving on it.
+    """
+
+    def __init__(self, host, port, options, workers=1, backlog=1024,
+                 graceful_timeout=30, ready_timeout=60, reuse_port=False):
+        """
+        :param host: The address to listen on
+        :type host: string
+        :param port: The port to listen on
+        :type port: int
+        :param options: The run_gevent options, passed to each GeventWorker
+        :type options: dict
+        :param workers: The number of workers to keep running
+        :type workers: int
+        :param backlog: The listen backlog of the socket
+        :type backlog: int
+        :param graceful_timeout: Seconds workers get to finish requests on shutdown
+        :type graceful_timeout: int
+        :param ready_timeout: Seconds a new worker gets to start accepting connections
+        :type ready_timeout: int
+        :param reuse_port: If each worker should bind its own SO_REUSEPORT socket
+        :type reuse_port: bool
+        """
+        self.host = host
+        self.port = port
+        self.options = options
+        self.num_workers = max(workers, 1)
+        self.backlog = backlog
+        self.graceful_timeout = graceful_timeout
+        self.ready_timeout = ready_timeout
+        self.reuse_port = reuse_port
+
+        self.pid = os.getpid()
+        self.workers = {}
+        self.listener = None
+        self.stopping = False
+        self.stop_deadline = None
+        self.restart_queue = []
+        self.last_failure = 0
+
+        self._signals = []
+        self._wakeup_r = self._wakeup_w = None
+
+    def run(self):
+        """
+        Runs the master until it's shut down
+        """
+        self.listener = self.bind()
+        self.install_signals()
+
+        logger.info("Master %s listening on %s:%s with %s workers.",
+                    self.pid, self.host, self.port, self.num_workers)
+
+        try:
+            while True:
+                self.handle_signals()
+                self.reap_workers()
+
+                if self.stopping:
+                    if not self.workers:
+                        break
+                    self.check_stop_deadline()
+                else:
+                    self.manage_workers()
+
+                self.wait(1.0)
+        finally:
+            if self.listener is not None:
+                self.listener.close()
+
+        logger.info("Master %s shut down.", self.pid)
+
+    def bind(self):
+        """
+        Creates the listening socket that all of the workers accept on.
+        With reuse_port the workers bind their own sockets, so the address
+        is only checked here and None is returned.
+        """
+        if self.reuse_port:
+            # Fail here rather than in every worker
+            bind_socket(self.host, self.port, reuse_port=True).close()
+            return None
+
+        listener = bind_socket(self.host, self.port)
+        listener.listen(self.backlog)
+        return listener
+
+    def install_signals(self):
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            _set_non_blocking(fd)
+
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGQUIT, signal.SIGHUP, signal.SIGCHLD):
+            signal.signal(sig, self._signal_handler)
+
+    def _signal_handler(self, sig, frame):
+        # Only queue the signal here, it's handled from the main loop
+        self._signals.append(sig)
+        try:
+            os.write(self._wakeup_w, '.')
+        except OSError:
+            pass
+
+    def handle_signals(self):
+        while self._signals:
+            sig = self._signals.pop(0)
+
+            if sig == signal.SIGTERM:
+                self.stop(graceful=True)
+            elif sig in (signal.SIGINT, signal.SIGQUIT):
+                self.stop(graceful=False)
+            elif sig == signal.SIGHUP and not self.stopping:
+                logger.info("Rolling restart of %s workers.", len(self.workers))
+                self.restart_queue = [w.pid for w in self.workers.itervalues()
+                                      if not w.retiring and not w.replaces]
+
+    def wait(self, timeout):
+        """
+        Waits for a signal, a message from a worker, or the timeout
+        """
+        pipes = dict((w.pipe, w) for w in self.workers.itervalues())
+        try:
+            readable, _, _ = select.select([self._wakeup_r] + pipes.keys(), [], [], timeout)
+        except select.error as ex:
+            if ex.args[0] == errno.EINTR:
+                return
+            raise
+
+        for fd in readable:
+            if fd == self._wakeup_r:
+                _drain(fd)
+            else:
+                self.handle_messages(pipes[fd], _drain(fd))
+
+    def handle_messages(self, worker, messages):
+        if WORKER_RECYCLE in messages and not worker.recycling and not worker.retiring:
+            logger.info("Recycling worker %s.", worker.pid)
+            worker.recycling = True
+            if worker.pid not in self.restart_queue:
+                self.restart_queue.append(worker.pid)
+
+        if WORKER_READY in messages and not worker.ready:
+            worker.ready = True
+            logger.info("Worker %s is ready.", worker.pid)
+
+            if worker.replaces:
+                old = self.workers.get(worker.replaces)
+                worker.replaces = None
+                if old is not None:
+                    self.retire(old)
+
+    def spawn_worker(self, replaces=None):
+        """
+        Forks a new worker.  In the child, this never returns.
+        """
+        if replaces:
+            index = self.workers[replaces].index
+        else:
+            index = self.free_index()
+
+        pipe_r, pipe_w = os.pipe()
+        pid = os.fork()
+
+        if pid == 0:
+            try:
+                os.close(pipe_r)
+                self._close_master_fds()
+                GeventWorker(self.pid, self.listener, pipe_w, self.options,
+                             graceful_timeout=self.graceful_timeout,
+                             index=index,
+                             address=(self.host, self.port),
+                             backlog=self.backlog).run()
+            finally:
+                # Never fall back into the master's loop
+                os._exit(1)
+
+        os.close(pipe_w)
+        _set_non_blocking(pipe_r)
+        self.workers[pid] = WorkerProcess(pid, pipe_r, index, replaces=replaces)
+        logger.info("Spawned worker %s.", pid)
+        return self.workers[pid]
+
+    def free_index(self):
+        """
+        Gets the lowest slot not taken by a running worker
+        """
+        taken = set(w.index for w in self.workers.itervalues()
+                    if not w.retiring and not w.replaces)
+        index = 0
+        while index in taken:
+            index += 1
+        return index
+
+    def _close_master_fds(self):
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGQUIT, signal.SIGHUP, signal.SIGCHLD):
+            signal.signal(sig, signal.SIG_DFL)
+        for fd in [self._wakeup_r, self._wakeup_w] + [w.pipe for w in self.workers.itervalues()]:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def retire(self, worker, sig=signal.SIGTERM):
+        """
+        Tells the worker to stop.  It's respawned unless it was replaced first.
+        """
+        if not worker.retiring:
+            worker.retiring = True
+            worker.retired_at = time.time()
+        self.kill(worker.pid, sig)
+
+    def kill(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except OSError as ex:
+            if ex.errno != errno.ESRCH:
+                raise
+
+    def reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as ex:
+                if ex.errno == errno.ECHILD:
+                    return
+                raise
+
+            if not pid:
+                return
+
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+
+            try:
+                os.close(worker.pipe)
+            except OSError:
+                pass
+
+            # A replacement for this worker now fills its slot, so it counts
+            # as active instead of another worker being spawned for the slot
+            for other in self.workers.itervalues():
+                if other.replaces == pid:
+                    other.replaces = None
+
+            if not worker.retiring and not self.stopping:
+                logger.warning("Worker %s died with status %s.", pid, status)
+                if not worker.ready:
+                    self.last_failure = time.time()
+                if worker.replaces:
+                    self.requeue_replaced(worker)
+
+    def manage_workers(self):
+        """
+        Keeps num_workers workers running, and steps the rolling restart along
+        """
+        now = time.time()
+
+        for worker in self.workers.values():
+            if worker.replaces and not worker.ready and now - worker.started > self.ready_timeout:
+                logger.error("Replacement worker %s didn't start in time, killing it.", worker.pid)
+                self.requeue_replaced(worker)
+                self.retire(worker, signal.SIGKILL)
+            elif worker.retiring and now - worker.retired_at > self.graceful_timeout + 5:
+                # The worker didn't drain in time
+                self.kill(worker.pid, signal.SIGKILL)
+
+        active = [w for w in self.workers.itervalues() if not w.retiring and not w.replaces]
+
+        # Back off spawning for a second if workers are dying on startup
+        if len(active) < self.num_workers and now - self.last_failure > 1:
+            for _ in xrange(self.num_workers - len(active)):
+                self.spawn_worker()
+
+        replacing = any(w.replaces for w in self.workers.itervalues())
+        while self.restart_queue and not replacing and now - self.last_failure > 1:
+            old = self.workers.get(self.restart_queue.pop(0))
+            if old is not None and not old.retiring:
+                self.spawn_worker(replaces=old.pid)
+                replacing = True
+
+    def requeue_replaced(self, worker):
+        """
+        Puts the worker that a failed replacement was for back on the restart
+        queue, so the recycle or rolling restart is tried again
+        """
+        old = self.workers.get(worker.replaces)
+        worker.replaces = None
+        if old is not None and not old.retiring:
+            # The old worker only asks to be recycled once, so it's up to the
+            # master to try again, and to listen if it asks again
+            old.recycling = False
+            if old.pid not in self.restart_queue:
+                self.restart_queue.append(old.pid)
+
+    def stop(self, graceful=True):
+        """
+        Stops the workers.  Graceful stops give the workers the graceful timeout
+        to finish their requests, after which they are killed.
+        """
+        if self.stopping and graceful:
+            return
+
+        logger.info("Master %s shutting down%s.", self.pid, " gracefully" if graceful else "")
+        self.stopping = True
+        self.restart_queue = []
+        self.stop_deadline = time.time() + (self.graceful_timeout if graceful else 0)
+
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+
+        for worker in self.workers.values():
+            self.retire(worker, signal.SIGTERM if graceful else signal.SIGQUIT)
+
+    def check_stop_deadline(self):
+        if time.time() > self.stop_deadline:
+            for worker in self.workers.values():
+                self.kill(worker.pid, signal.SIGKILL)
+
+
+class GeventWorker(object):
+    """
+    A forked worker serving the WSGI application with gevent on the
+    master's listening socket.
+    """
+
+    # Seconds between checks of the recycling thresholds
+    RECYCLE_CHECK_INTERVAL = 1
+
+    # Extra connections accepted when shedding load, as a fraction of worker_connections
+    SHED_HEADROOM = 0.1
+    SHED_RESPONSE = '503 Service Unavailable'
+
+    def __init__(self, master_pid, listener, pipe, options, graceful_timeout=30,
+                 index=0, address=None, backlog=1024):
+        self.master_pid = master_pid
+        self.listener = listener
+        self.pipe = pipe
+        self.options = options
+        self.graceful_timeout = graceful_timeout
+        self.index = index
+        self.address = address
+        self.backlog = backlog
+        self.server = None
+
+        self.started = time.time()
+        self.requests = 0
+
+    def run(self):
+        """
+        Serves until the worker is told to stop.  Never returns.
+        """
+        try:
+            self.init_process()
+            self.server = self.create_server(self.get_application())
+            self.server.start()
+            self.notify(WORKER_READY)
+
+            import gevent
+            gevent.spawn(self.watch_master)
+            if self.has_recycle_limits():
+                gevent.spawn(self.watch_recycle_limits)
+
+            self.server.serve_forever()
+        except Exception:
+            logger.exception("Worker %s failed.", os.getpid())
+            os._exit(1)
+
+        os._exit(0)
+
+    def init_process(self):
+        """
+        Monkey patches the worker process and installs its signal handlers
+        """
+        from gevent import monkey
+        monkey.patch_all()
+
+        if self.options.get('cpu_affinity'):
+            set_cpu_affinity(self.index)
+
+        if not self.options.get('disable_psycogreen'):
+            # Monkey Patch for Psycopg2 using psycogreen
+            import psycogreen.gevent
+            psycogreen.gevent.patch_psycopg()
+
+        import gevent
+        signal_handler = getattr(gevent, 'signal_handler', None) or gevent.signal
+        signal_handler(signal.SIGTERM, self.stop)
+        signal_handler(signal.SIGQUIT, lambda: os._exit(0))
+
+    def get_application(self):
+        from jpylib.django import bootstrap
+        application = bootstrap.bootstrap_wsgi()
+
+        def counted_application(environ, start_response):
+            self.requests += 1
+            return application(environ, start_response)
+
+        return counted_application
+
+    def get_listener(self):
+        """
+        Gets the master's listening socket as a gevent socket, or binds the
+        worker's own if the master didn't share one
+        """
+        from gevent import socket as gsocket
+
+        if self.listener is None:
+            host, port = self.address
+            listener = bind_socket(host, port, reuse_port=True)
+            listener.listen(self.backlog)
+            return gsocket.socket(_sock=listener._sock)
+
+        return gsocket.fromfd(self.listener.fileno(), socket.AF_INET, socket.SOCK_STREAM)
+
+    def create_server(self, application):
+        listener = self.get_listener()
+        pool = self.create_pool()
+
+        if self.options.get('shed_load') and pool is not None:
+            application = self.shedding_application(application, pool,
+                                                    self.options['worker_connections'])
+
+        if self.options.get('disable_socketio'):
+            from gevent.pywsgi import WSGIServer
+            return WSGIServer(listener, application, spawn=pool or 'default')
+        else:
+            from socketio.server import SocketIOServer
+            return SocketIOServer(listener, application, resource="socket.io",
+                                  spawn=pool or 'default')
+
+    def create_pool(self):
+        """
+        Creates the greenlet pool that limits the connections handled at once,
+        or None if they aren't limited
+        """
+        from gevent.pool import Pool
+
+        size = self.options.get('worker_connections')
+        if not size:
+            return None
+        if self.options.get('shed_load'):
+            size += max(int(size * self.SHED_HEADROOM), 1)
+        return Pool(size)
+
+    def shedding_application(self, application, pool, limit):
+        """
+        Wraps the application to answer with a 503 when more than limit
+        connections are being handled
+        """
+        def shedding_application(environ, start_response):
+            # The pool includes the greenlet handling this request
+            if len(pool) > limit:
+                start_response(self.SHED_RESPONSE, [('Content-Type', 'text/plain'),
+                                                    ('Retry-After', '1'),
+                                                    ('Connection', 'close')])
+                return [self.SHED_RESPONSE]
+            return application(environ, start_response)
+
+        return shedding_application
+
+    def notify(self, message):
+        try:
+            os.write(self.pipe, message)
+        except OSError:
+            pass
+
+    def stop(self):
+        """
+        Stops accepting connections and lets the current requests finish
+        """
+        import gevent
+        if self.server is not None:
+            gevent.spawn(self.server.stop, timeout=self.graceful_timeout)
+        else:
+            os._exit(0)
+
+    def jittered(self, limit):
+        """
+        Adds up to recycle_jitter of the limit to it, so workers started
+        together don't all recycle together
+        """
+        if not limit:
+            return None
+        return limit * (1 + random.uniform(0, self.options.get('recycle_jitter') or 0))
+
+    def has_recycle_limits(self):
+        return bool(self.options.get('max_requests') or
+                    self.options.get('max_memory') or
+                    self.options.get('max_age'))
+
+    def recycle_reason(self, max_requests, max_rss, max_age):
+        """
+        Gets why the worker should be recycled, or None if it shouldn't be
+        """
+        if max_requests and self.requests >= max_requests:
+            return "served %s requests" % self.requests
+        if max_age and time.time() - self.started >= max_age:
+            return "reached max age"
+        if max_rss:
+            rss = get_rss()
+            if rss >= max_rss:
+                return "RSS is %sMB" % (rss / (1024 * 1024))
+        return None
+
+    def watch_recycle_limits(self):
+        """
+        Asks the master to replace this worker once it crosses a recycling threshold
+        """
+        import gevent
+
+        # Forked workers share the master's random state
+        random.seed()
+        max_requests = self.jittered(self.options.get('max_requests'))
+        max_rss = self.jittered((self.options.get('max_memory') or 0) * 1024 * 1024)
+        max_age = self.jittered(self.options.get('max_age'))
+
+        while True:
+            reason = self.recycle_reason(max_requests, max_rss, max_age)
+            if reason:
+                logger.info("Worker %s %s, asking to be recycled.", os.getpid(), reason)
+                self.notify(WORKER_RECYCLE)
+                return
+            gevent.sleep(self.RECYCLE_CHECK_INTERVAL)
+
+    def watch_master(self):
+        """
+        Stops the worker if the master goes away
+        """
+        import gevent
+        while os.getppid() == self.master_pid:
+            gevent.sleep(1)
+        logger.warning("Master %s is gone, worker %s stopping.", self.master_pid, os.getpid())
+        self.stop()
+
+
+def bind_socket(host, port, reuse_port=False):
+    """
+    Creates a TCP socket bound to the address
+
+    :param reuse_port: Set SO_REUSEPORT, so several processes can bind the address
+    :type reuse_port: bool
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        if SO_REUSEPORT is None:
+            raise socket.error("SO_REUSEPORT isn't supported on {}.".format(sys.platform))
+        listener.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    listener.bind((host, port))
+    return listener
+
+
+def set_cpu_affinity(index):
+    """
+    Pins the current process to one CPU, picked by the index.  Uses psutil,
+    since Python 2 has no os.sched_setaffinity.
+    """
+    if psutil is None:
+        logger.warning("psutil isn't installed, can't set the CPU affinity.")
+        return
+
+    process = psutil.Process(os.getpid())
+    cpus = process.cpu_affinity()
+    cpu = cpus[index % len(cpus)]
+    process.cpu_affinity([cpu])
+    logger.info("Worker %s pinned to CPU %s.", os.getpid(), cpu)
+
+
+def get_rss():
+    """
+    Gets the resident set size of the current process in bytes
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        # Not Linux, fall back to the peak RSS.  getrusage gives it in bytes
+        # on OS X, and in KB on Linux and the BSDs.
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def _set_non_blocking(fd):
+    import fcntl
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def _drain(fd):
+    """
+    Reads everything waiting on the non-blocking fd
+    """
+    data = []
+    while True:
+        try:
+            chunk = os.read(fd, 4096)
+        except OSError as ex:
+            if ex.errno in (errno.EAGAIN, errno.EINTR):
+                break
+            raise
+        if not chunk:
+            break
+        data.append(chunk)
+    return ''.join(data)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Management command to dump the request timing histograms recorded by
+the TimingMiddleware
+"""
+import json
+import optparse
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from jpylib.django.middleware.timing import (STATS_DIR, HISTOGRAM_BUCKETS,
+                                             TimingStats, percentile)
+
+
+SORT_FIELDS = ('total', 'count', 'mean', 'max', 'db', 'cache', 'wait')
+
+
+class Command(BaseCommand):
+    """
+    Prints the per URL pattern timings merged from all of the processes
+    """
+
+    option_list = BaseCommand.option_list
+    option_list += (
+        optparse.make_option('-d', '--dir', dest='stats_dir', default=STATS_DIR,
+                             help="The directory the timings are written to. "
+                                  "Defaults to the TIMING_STATS_DIR setting"),
+        optparse.make_option('-s', '--sort', dest='sort', default='total',
+                             help="The column to sort by, one of: " + ", ".join(SORT_FIELDS)),
+        optparse.make_option('-l', '--limit', dest='limit', type='int', default=0,
+                             help="The most URL patterns to print"),
+        optparse.make_option('-j', '--json', dest='json', action='store_true', default=False,
+                             help="Print the merged histograms as JSON"),
+        optparse.make_option('-c', '--clear', dest='clear', action='store_true', default=False,
+                             help="Delete the timings files after dumping them"),
+    )
+
+    help = 'Dumps the request timing histograms recorded by the TimingMiddleware'
+
+    def handle(self, *args, **options):
+        if options['sort'] not in SORT_FIELDS:
+            raise CommandError("Can't sort by {}.  Use one of: {}".format(
+                options['sort'], ", ".join(SORT_FIELDS)))
+
+        patterns = TimingStats.load_all(options['stats_dir'])
+
+        if options['json']:
+            print json.dumps({'buckets': HISTOGRAM_BUCKETS, 'patterns': patterns}, indent=2)
+        else:
+            self.print_table(patterns, options['sort'], options['limit'])
+
+        if options['clear'] and os.path.isdir(options['stats_dir']):
+            for name in os.listdir(options['stats_dir']):
+                if name.endswith('.json'):
+                    os.remove(os.path.join(options['stats_dir'], name))
+
+    def print_table(self, patterns, sort, limit):
+        rows = []
+        for pattern, entry in patterns.iteritems():
+            count = entry['count'] or 1
+            rows.append({
+                'pattern': pattern,
+                'count': entry['count'],
+                'total': entry['total'],
+                'mean': entry['total'] / count,
+                'p50': percentile(entry['buckets'], 0.5),
+                'p95': percentile(entry['buckets'], 0.95),
+                'p99': percentile(entry['buckets'], 0.99),
+                'max': entry['max'],
+                'queries': float(entry['db_count']) / count,
+                'db': entry['db_time'] / count,
+                'cache': entry['cache_time'] / count,
+                'wait': entry['wait_time'] / count,
+            })
+
+        rows.sort(key=lambda row: row[sort], reverse=True)
+        if limit:
+            rows = rows[:limit]
+
+        print ('{:<40} {:>8} {:>9} {:>7} {:>7} {:>7} {:>9} {:>8} {:>8} {:>8} {:>8}'.format(
+            'pattern', 'count', 'mean ms', 'p50', 'p95', 'p99', 'max ms',
+            'queries', 'db ms', 'cache ms', 'wait ms'))
+
+        for row in rows:
+            print ('{pattern:<40} {count:>8} {mean:>9.1f} {p50:>7} {p95:>7} {p99:>7} '
+                   '{max:>9.1f} {queries:>8.1f} {db:>8.1f} {cache:>8.1f} {wait:>8.1f}'.format(
+                       **dict(row, **dict((p, _bound(row[p])) for p in ('p50', 'p95', 'p99')))))
+
+
+def _bound(value):
+    """
+    Formats a percentile bucket bound, None being past the last bucket
+    """
+    return '<=%s' % value if value is not None else '>%s' % HISTOGRAM_BUCKETS[-1]
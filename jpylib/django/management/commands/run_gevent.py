@@ -5,23 +5,26 @@ This is the script that will start up the Gevent WSGI server
 import multiprocessing
 import optparse
 
-from gevent import monkey
-from gevent.os import fork
-
 from django.core.management.base import BaseCommand, CommandError
 
-from .django import bootstrap
+from jpylib.django.gevent_server import PreforkMaster
 
 
 class Command(BaseCommand):
     """
-    Management command to run non-blocking gevent WSGI server
+    Management command to run non-blocking gevent WSGI server.  A master
+    process binds the socket and supervises the forked gevent workers.
+    Send the master TERM to drain the workers and shut down, or HUP
+    for a rolling restart of the workers.  Workers can be recycled by
+    request count, memory or age with --max-requests, --max-memory
+    and --max-age.
     """
 
     option_list = BaseCommand.option_list
     option_list += (
         optparse.make_option('-w', '--child-workers', dest='child_workers',
-                             help='The number of CHILD workers to spawn. '
+                             type='int',
+                             help='The number of workers to spawn. '
                                   'Set to 0 for 1 worker',
                              default=multiprocessing.cpu_count()),
         optparse.make_option('-s', '--disable-socketio', dest='disable_socketio',
@@ -32,6 +35,55 @@ class Command(BaseCommand):
                              action='store_true',
                              help='Set if you want to disable psycogreen support',
                              default=False),
+        optparse.make_option('-g', '--graceful-timeout', dest='graceful_timeout',
+                             type='int',
+                             help='Seconds workers get to finish their requests on '
+                                  'shutdown or restart before they are killed',
+                             default=30),
+        optparse.make_option('--max-requests', dest='max_requests',
+                             type='int',
+                             help='Recycle a worker after it serves this many requests. '
+                                  '0 to disable',
+                             default=0),
+        optparse.make_option('--max-memory', dest='max_memory',
+                             type='int',
+                             help='Recycle a worker once its RSS grows past this many MB. '
+                                  '0 to disable',
+                             default=0),
+        optparse.make_option('--max-age', dest='max_age',
+                             type='int',
+                             help='Recycle a worker after it runs for this many seconds. '
+                                  '0 to disable',
+                             default=0),
+        optparse.make_option('--recycle-jitter', dest='recycle_jitter',
+                             type='float',
+                             help='Each worker raises its recycling thresholds by a '
+                                  'random fraction up to this, so workers '
+                                  'don\'t recycle together',
+                             default=0.1),
+        optparse.make_option('-c', '--worker-connections', dest='worker_connections',
+                             type='int',
+                             help='The most connections a worker handles at once. '
+                                  '0 for no limit',
+                             default=1000),
+        optparse.make_option('-b', '--backlog', dest='backlog',
+                             type='int',
+                             help='The listen backlog of connections waiting to be accepted',
+                             default=1024),
+        optparse.make_option('--shed-load', dest='shed_load',
+                             action='store_true',
+                             help='Answer with a 503 when a worker has more than '
+                                  'worker-connections connections',
+                             default=False),
+        optparse.make_option('--reuse-port', dest='reuse_port',
+                             action='store_true',
+                             help='Have each worker bind its own SO_REUSEPORT socket, '
+                                  'so the kernel balances connections across them',
+                             default=False),
+        optparse.make_option('--cpu-affinity', dest='cpu_affinity',
+                             action='store_true',
+                             help='Pin each worker to its own CPU. Requires psutil',
+                             default=False),
     )
 
     help = ('Runs non-blocking Gevent WSGI server with '
@@ -53,40 +105,20 @@ class Command(BaseCommand):
             if port is None:
                 port = 80
 
-            # Monkey Patch for Gevent
-            monkey.patch_all()
-
-            if not options['disable_psycogreen']:
-                # Monkey Patch for Psycopg2 using psycogreen
-                import psycogreen.gevent
-                psycogreen.gevent.patch_psycopg()
-
-            application = bootstrap.get_wsgi_application()
-
-            if options['disable_socketio']:
-                from gevent.pywsgi import WSGIServer
-                server = WSGIServer((host, int(port)), application)
-            else:
-                from socketio.server import SocketIOServer
-                server = SocketIOServer((host, int(port)), application, resource="socket.io")
+            workers = max(options['child_workers'], 1)
 
             print 'Starting server on {host}:{port} with {workers} workers.'.format(
                 host=host,
                 port=port,
-                workers=options['child_workers']
+                workers=workers
             )
 
-            server.start()
-
-            print 'Listening on http://{host}:{port}'.format(host=host, port=port)
-
-            for i in range(options['child_workers']):
-                pid = fork()
-                if pid == 0:
-                    break
-
-            server.serve_forever()
+            master = PreforkMaster(host, int(port), options,
+                                   workers=workers,
+                                   backlog=options['backlog'],
+                                   reuse_port=options['reuse_port'],
+                                   graceful_timeout=options['graceful_timeout'])
+            master.run()
 
         except Exception, ex:
             raise CommandError("Exception occurred during gevent wsgi process startup.", ex)
-
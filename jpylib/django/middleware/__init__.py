@@ -3,4 +3,5 @@ This module contains Unified's standard Django library's middleware
 """
 from .angularcsrf import *
 from .cross_site_xhr import *
-from .response_exception import *
\ No newline at end of file
+from .response_exception import *
+from .timing import *
\ No newline at end of file
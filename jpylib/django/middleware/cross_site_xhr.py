@@ -12,6 +12,58 @@ ALLOWED_CREDENTIALS = 'true'
 DEFAULT_XS_SHARING = getattr(settings, 'DEFAULT_XS_SHARING', None)
 XS_SHARING_ALLOWED_PATH = getattr(settings, 'XS_SHARING_ALLOWED_PATHS', {})
 
+# Key of the rule stored on a PathTrie node
+_RULE = None
+
+
+def compile_headers(value):
+    """
+    Builds the CORS headers for a sharing rule
+
+    :param value: The rule from XS_SHARING_ALLOWED_PATHS or DEFAULT_XS_SHARING
+    :type value: dict
+    :returns: tuple of (header, value) pairs
+    """
+    return (
+        ('Access-Control-Allow-Origin', ",".join(value.get('origins', ALL_ORIGINS))),
+        ('Access-Control-Allow-Methods', ",".join(value.get('methods', ALL_METHODS))),
+        ('Access-Control-Allow-Headers', ",".join(value.get('headers', ALL_HEADERS))),
+        ('Access-Control-Allow-Credentials', value.get('credentials', ALLOWED_CREDENTIALS)),
+    )
+
+
+class PathTrie(object):
+    """
+    Character trie of path prefixes, used to find the longest
+    configured prefix of a request path in one walk of the path.
+    """
+
+    def __init__(self, rules=None):
+        self.root = {}
+        for prefix, value in (rules or {}).iteritems():
+            self.add(prefix, value)
+
+    def add(self, prefix, value):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[_RULE] = value
+
+    def longest_prefix(self, path):
+        """
+        Gets the value of the longest prefix of the path, or None
+        """
+        node = self.root
+        match = node.get(_RULE)
+        for char in path:
+            node = node.get(char)
+            if node is None:
+                break
+            if _RULE in node:
+                match = node[_RULE]
+        return match
+
+
 class CrossSiteXHR(object):
     """
     This middleware allows cross-domain XHR using the html5 postMessage API.
@@ -19,8 +71,18 @@ class CrossSiteXHR(object):
     Access-Control-Allow-Origin: http://foo.example
     Access-Control-Allow-Methods: POST, GET, OPTIONS, PUT, DELETE
 
+    The path prefixes and their headers are compiled once when the middleware
+    is loaded.  When several prefixes match a path, the longest one is used.
+    Requests without an Origin header aren't cross-site, so they're skipped.
+
     Based off https://gist.github.com/426829
     """
+
+    def __init__(self):
+        self.paths = PathTrie(dict((path, compile_headers(value))
+                                   for path, value in XS_SHARING_ALLOWED_PATH.iteritems()))
+        self.default_headers = compile_headers(DEFAULT_XS_SHARING) if DEFAULT_XS_SHARING else None
+
     def process_request(self, request):
         """
         Processes the requests to see if they are allowed for XHR. XHR requests will
@@ -30,7 +92,7 @@ class CrossSiteXHR(object):
         :param request: the request from Django
         :type request: HttpRequest
         """
-        if 'HTTP_ACCESS_CONTROL_REQUEST_METHOD' in request.META:
+        if 'HTTP_ORIGIN' in request.META and 'HTTP_ACCESS_CONTROL_REQUEST_METHOD' in request.META:
             response = http.HttpResponse()
             return self.get_response(request, response)
 
@@ -47,6 +109,9 @@ class CrossSiteXHR(object):
 
         :returns: The response with updated headers if the XHR request is allowed
         """
+        if 'HTTP_ORIGIN' not in request.META:
+            return response
+
         return self.get_response(request, response)
 
     def get_response(self, request, response):
@@ -60,40 +125,10 @@ class CrossSiteXHR(object):
 
         :returns: The response with updated headers if the XHR request is allowed
         """
+        headers = self.paths.longest_prefix(request.path) or self.default_headers
 
-        for path, value in XS_SHARING_ALLOWED_PATH.iteritems():
-            if request.path.startswith(path):
-
-                response['Access-Control-Allow-Origin']  = ",".join(value.get('origins',
-                                                                              ALL_ORIGINS))
-
-                response['Access-Control-Allow-Methods'] = ",".join(value.get('methods',
-                                                                              ALL_METHODS))
-
-                response['Access-Control-Allow-Headers'] = ",".join(value.get('headers',
-                                                                              ALL_HEADERS))
-
-                response['Access-Control-Allow-Credentials'] = value.get('credentials',
-                                                                         ALLOWED_CREDENTIALS)
-                return response
-
-        if DEFAULT_XS_SHARING:
-
-            response['Access-Control-Allow-Origin']  = ",".join(DEFAULT_XS_SHARING.get(
-                'origins',
-                ALL_ORIGINS))
-
-            response['Access-Control-Allow-Methods'] = ",".join(DEFAULT_XS_SHARING.get(
-                'methods',
-                ALL_METHODS))
-
-            response['Access-Control-Allow-Headers'] = ",".join(DEFAULT_XS_SHARING.get(
-                'headers',
-                ALL_HEADERS))
-            response['Access-Control-Allow-Credentials'] = DEFAULT_XS_SHARING.get(
-                'credentials',
-                ALLOWED_CREDENTIALS)
-
-            return response
+        if headers:
+            for header, value in headers:
+                response[header] = value
 
         return response
@@ -1,7 +1,7 @@
 """
 Middleware class implementation for the ResponseException
 """
-from .django.exceptions import ResponseException
+from jpylib.django.exceptions import ResponseException
 
 
 class ResponseExceptionMiddleware(object):
@@ -0,0 +1,482 @@
+"""
+Middleware that times requests.  For every request it records the wall
+time, the number and time of DB queries, the number and time of cache
+calls, and with gevent, the time the request's greenlet spent switched
+out waiting.
+
+Settings:
+    TIMING_SERVER_TIMING_HEADER:    Add a Server-Timing header to responses. Default True
+    TIMING_SLOW_REQUEST:            Seconds after which a request is slow. Slow requests
+                                    are logged with a sampled stack profile. Default 1
+    TIMING_SAMPLE_INTERVAL:         Seconds between stack samples of slow requests. Default 0.01
+    TIMING_STATS_DIR:               Directory each process writes its per URL pattern
+                                    histograms to, for the dump_timings command.  Only
+                                    used if other users can't write to it. Default
+                                    ~/.cache/jpylib/timings
+    TIMING_FLUSH_INTERVAL:          Seconds between writes of the histograms. Default 60
+
+Add it first in MIDDLEWARE_CLASSES so it times the other middleware too.
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import weakref
+
+from django.conf import settings
+from django.core.signals import request_finished
+
+from jpylib.private_files import check_private_dir, get_private_dir, write_atomic
+from jpylib.profiling import collapse_stack, format_collapsed, _original
+
+try:
+    import gevent
+    from gevent import monkey as gevent_monkey
+    import greenlet
+except ImportError:
+    gevent = None
+
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['RequestTimings', 'TimingMiddleware', 'get_current_timings']
+
+SERVER_TIMING_HEADER = getattr(settings, 'TIMING_SERVER_TIMING_HEADER', True)
+SLOW_REQUEST = getattr(settings, 'TIMING_SLOW_REQUEST', 1)
+SAMPLE_INTERVAL = getattr(settings, 'TIMING_SAMPLE_INTERVAL', 0.01)
+STATS_DIR = getattr(settings, 'TIMING_STATS_DIR', get_private_dir('timings'))
+FLUSH_INTERVAL = getattr(settings, 'TIMING_FLUSH_INTERVAL', 60)
+
+# Upper bounds of the histogram buckets, in ms.  The last bucket has no bound.
+HISTOGRAM_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+CACHE_METHODS = ('get', 'set', 'add', 'delete', 'get_many', 'set_many',
+                 'delete_many', 'incr', 'decr', 'has_key')
+
+# Stacks included in the slow request log
+SLOW_REQUEST_STACKS = 10
+
+_local = threading.local()
+# Weak, so the timings of a request whose greenlet died without finishing are dropped
+_greenlet_timings = weakref.WeakKeyDictionary()
+_hooks_installed = False
+
+
+def _using_gevent():
+    return gevent is not None and gevent_monkey.is_module_patched('threading')
+
+
+def get_current_timings():
+    """
+    Gets the RequestTimings of the request being handled, or None
+    """
+    return getattr(_local, 'timings', None)
+
+
+class RequestTimings(object):
+    """
+    The timings of one request
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.end = None
+        self.db_count = 0
+        self.db_time = 0.0
+        self.cache_count = 0
+        self.cache_time = 0.0
+        self.wait_time = 0.0
+        # Set while switched out, for the greenlet wait time
+        self.switched_out = None
+        # Set while inside a timed call, so nested wrappers don't count twice
+        self.in_call = False
+
+    @property
+    def total_time(self):
+        return (self.end or time.time()) - self.start
+
+    def server_timing(self):
+        """
+        Gets the value of the Server-Timing header, with durations in ms
+        """
+        metrics = [
+            'total;dur=%.1f' % (self.total_time * 1000),
+            'db;desc="%d queries";dur=%.1f' % (self.db_count, self.db_time * 1000),
+            'cache;desc="%d calls";dur=%.1f' % (self.cache_count, self.cache_time * 1000),
+        ]
+        if _using_gevent():
+            metrics.append('wait;dur=%.1f' % (self.wait_time * 1000))
+        return ', '.join(metrics)
+
+
+def _timed(method, counter):
+    """
+    Wraps the method to add its calls to the current request's timings.
+    counter is 'db' or 'cache'.
+    """
+    def timed(*args, **kwargs):
+        timings = get_current_timings()
+        if timings is None or timings.in_call:
+            return method(*args, **kwargs)
+
+        timings.in_call = True
+        start = time.time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            timings.in_call = False
+            if counter == 'db':
+                timings.db_count += 1
+                timings.db_time += elapsed
+            else:
+                timings.cache_count += 1
+                timings.cache_time += elapsed
+
+    timed.__name__ = getattr(method, '__name__', 'timed')
+    return timed
+
+
+def _cursor_method(name):
+    """
+    Gets a cursor method for CursorWrapper classes that don't define it,
+    going through __getattr__ like the unwrapped class does
+    """
+    from django.db.backends import util
+
+    def method(self, *args, **kwargs):
+        return util.CursorWrapper.__getattr__(self, name)(*args, **kwargs)
+
+    return method
+
+
+def _trace_greenlets(previous):
+    """
+    Gets a greenlet trace function that adds the time a request's greenlet
+    was switched out to the request's wait time
+    """
+    def trace(event, args):
+        if event in ('switch', 'throw'):
+            origin, target = args
+            now = time.time()
+
+            timings = _greenlet_timings.get(origin)
+            if timings is not None:
+                timings.switched_out = now
+
+            timings = _greenlet_timings.get(target)
+            if timings is not None and timings.switched_out is not None:
+                timings.wait_time += now - timings.switched_out
+                timings.switched_out = None
+
+        if previous is not None:
+            previous(event, args)
+
+    return trace
+
+
+def install_hooks():
+    """
+    Wraps the DB cursors and the default cache so their calls are timed.
+    CachedModel uses the default cache, so its calls are included.
+    """
+    global _hooks_installed
+    if _hooks_installed:
+        return
+    _hooks_installed = True
+
+    from django.core.cache import cache
+    from django.db.backends import util
+
+    for cursor_class in (util.CursorWrapper, util.CursorDebugWrapper):
+        for name in ('execute', 'executemany'):
+            method = cursor_class.__dict__.get(name) or _cursor_method(name)
+            setattr(cursor_class, name, _timed(method, 'db'))
+
+    for name in CACHE_METHODS:
+        method = getattr(cache, name, None)
+        if method is not None:
+            setattr(cache, name, _timed(method, 'cache'))
+
+    if _using_gevent():
+        greenlet.settrace(_trace_greenlets(greenlet.gettrace()))
+
+    request_finished.connect(_end_request, dispatch_uid='jpylib-timing-end-request')
+
+
+def _end_request(**kwargs):
+    """
+    Drops what's kept for the current request once it's finished, since
+    process_response isn't called for every request, ie. when a response
+    middleware raises before it
+    """
+    _local.timings = None
+    if _using_gevent():
+        _greenlet_timings.pop(gevent.getcurrent(), None)
+    if SLOW_REQUEST:
+        sampler.unregister()
+
+
+class SlowRequestSampler(object):
+    """
+    Samples the stacks of the requests that have run longer than the delay.
+    One sampler runs per process, so requests that finish sooner cost a
+    dict insert and removal.  The sampler is a real thread even with gevent,
+    so it samples greenlets that hog the CPU as well as the ones switched
+    out waiting, and it sleeps while there are no requests to sample.
+    """
+
+    def __init__(self, delay, interval):
+        self.delay = delay
+        self.interval = interval
+        # Thread id or greenlet of each request to its timings, sampled stacks
+        # and the id of the thread it runs in
+        self.active = {}
+        self._started = False
+        self._lock = threading.Lock()
+        # Held while there are no requests, released by register to wake the sampler
+        self._wakeup = _original('thread', 'allocate_lock')()
+        self._wakeup.acquire()
+
+    def register(self, timings):
+        """
+        Starts sampling the current request once it's slow
+        """
+        self.active[self._current_key()] = (timings, {}, _original('thread', 'get_ident')())
+        if not self._started:
+            self.start()
+        try:
+            self._wakeup.release()
+        except _original('thread', 'error'):
+            # The sampler is already awake
+            pass
+
+    def unregister(self):
+        """
+        Stops sampling the current request
+
+        :returns: dict of collapsed stack to sample count
+        """
+        entry = self.active.pop(self._current_key(), None)
+        return entry[1] if entry else {}
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            _original('thread', 'start_new_thread')(self._run, ())
+
+    def _current_key(self):
+        if _using_gevent():
+            return gevent.getcurrent()
+        return threading.current_thread().ident
+
+    def _run(self):
+        sleep = _original('time', 'sleep')
+        while True:
+            if not self.active:
+                self._wakeup.acquire()
+                continue
+            self.sample()
+            sleep(self.interval)
+
+    def sample(self):
+        now = time.time()
+        frames = None
+        for key, (timings, counts, thread_id) in self.active.items():
+            if _using_gevent() and key.dead:
+                # The request's greenlet ended without unregistering
+                self.active.pop(key, None)
+                continue
+            if now - timings.start < self.delay:
+                continue
+
+            # gr_frame is only set while the greenlet is switched out,
+            # else it's the one running in its thread
+            frame = key.gr_frame if _using_gevent() else None
+            if frame is None:
+                if frames is None:
+                    frames = sys._current_frames()
+                frame = frames.get(thread_id)
+
+            if frame is not None:
+                stack = collapse_stack(frame)
+                counts[stack] = counts.get(stack, 0) + 1
+
+
+class TimingStats(object):
+    """
+    Histograms of the request timings, per URL pattern.  Each process keeps
+    its own and writes them to a file in STATS_DIR, which the dump_timings
+    management command merges.
+    """
+
+    FIELDS = ('count', 'total', 'max', 'db_count', 'db_time',
+              'cache_count', 'cache_time', 'wait_time')
+
+    def __init__(self):
+        self.patterns = {}
+        self.last_flush = time.time()
+
+    @staticmethod
+    def new_entry():
+        entry = dict((field, 0) for field in TimingStats.FIELDS)
+        entry['buckets'] = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        return entry
+
+    def record(self, pattern, timings):
+        entry = self.patterns.get(pattern)
+        if entry is None:
+            entry = self.patterns[pattern] = self.new_entry()
+
+        total_ms = timings.total_time * 1000
+        entry['count'] += 1
+        entry['total'] += total_ms
+        entry['max'] = max(entry['max'], total_ms)
+        entry['db_count'] += timings.db_count
+        entry['db_time'] += timings.db_time * 1000
+        entry['cache_count'] += timings.cache_count
+        entry['cache_time'] += timings.cache_time * 1000
+        entry['wait_time'] += timings.wait_time * 1000
+
+        bucket = 0
+        while bucket < len(HISTOGRAM_BUCKETS) and total_ms > HISTOGRAM_BUCKETS[bucket]:
+            bucket += 1
+        entry['buckets'][bucket] += 1
+
+    def flush(self, force=False):
+        """
+        Writes this process's histograms to its file in STATS_DIR, at most
+        every FLUSH_INTERVAL seconds unless forced
+        """
+        now = time.time()
+        if not force and now - self.last_flush < FLUSH_INTERVAL:
+            return
+        self.last_flush = now
+
+        if not check_private_dir(STATS_DIR):
+            return
+
+        try:
+            path = os.path.join(STATS_DIR, 'timings-%s.json' % os.getpid())
+            write_atomic(path, json.dumps({'pid': os.getpid(), 'time': now, 'patterns': self.patterns}))
+        except (IOError, OSError):
+            logger.exception("Could not write the request timings to %s.", STATS_DIR)
+
+    @classmethod
+    def load_all(cls, stats_dir=STATS_DIR):
+        """
+        Merges the histograms written by all of the processes
+
+        :returns: dict of URL pattern to its merged histogram entry
+        """
+        merged = {}
+        if not os.path.isdir(stats_dir) or not check_private_dir(stats_dir, create=False, owned=False):
+            return merged
+
+        for name in os.listdir(stats_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(stats_dir, name)) as stats_file:
+                    patterns = json.load(stats_file)['patterns']
+            except (IOError, ValueError, KeyError):
+                logger.warning("Skipping unreadable timings file %s.", name)
+                continue
+
+            for pattern, entry in patterns.iteritems():
+                target = merged.setdefault(pattern, cls.new_entry())
+                for field in cls.FIELDS:
+                    if field == 'max':
+                        target[field] = max(target[field], entry[field])
+                    else:
+                        target[field] += entry[field]
+                target['buckets'] = [a + b for a, b in zip(target['buckets'], entry['buckets'])]
+
+        return merged
+
+
+def percentile(buckets, fraction):
+    """
+    Estimates a percentile of a histogram as the upper bound of its bucket
+
+    :param buckets: The bucket counts of a histogram entry
+    :param fraction: The percentile as a fraction, ie. 0.95
+    :returns: The bound in ms, or None if it's in the unbounded last bucket
+    """
+    target = sum(buckets) * fraction
+    seen = 0
+    for bound, count in zip(HISTOGRAM_BUCKETS, buckets):
+        seen += count
+        if seen >= target:
+            return bound
+    return None
+
+
+stats = TimingStats()
+sampler = SlowRequestSampler(SLOW_REQUEST, SAMPLE_INTERVAL)
+
+
+class TimingMiddleware(object):
+    """
+    Middleware that times each request, adds a Server-Timing header to its
+    response, logs it if it's slow, and adds it to the URL pattern histograms.
+    """
+
+    def __init__(self):
+        install_hooks()
+
+    def process_request(self, request):
+        timings = _local.timings = request._timings = RequestTimings()
+
+        if _using_gevent():
+            _greenlet_timings[gevent.getcurrent()] = timings
+
+        if SLOW_REQUEST:
+            sampler.register(timings)
+
+        return None
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._timing_pattern = self.get_pattern(request, view_func)
+        return None
+
+    def get_pattern(self, request, view_func):
+        """
+        Gets the name the request's timings are aggregated under: the URL
+        name if the pattern has one, else the view's path
+        """
+        resolver_match = getattr(request, 'resolver_match', None)
+        if resolver_match is not None and resolver_match.url_name:
+            return resolver_match.url_name
+        return '%s.%s' % (view_func.__module__, getattr(view_func, '__name__', view_func.__class__.__name__))
+
+    def process_response(self, request, response):
+        timings = getattr(request, '_timings', None)
+        if timings is None:
+            return response
+
+        timings.end = time.time()
+        _local.timings = None
+        if _using_gevent():
+            _greenlet_timings.pop(gevent.getcurrent(), None)
+
+        samples = sampler.unregister() if SLOW_REQUEST else None
+
+        if SERVER_TIMING_HEADER:
+            response['Server-Timing'] = timings.server_timing()
+
+        pattern = getattr(request, '_timing_pattern', None) or 'unresolved'
+
+        if SLOW_REQUEST and timings.total_time >= SLOW_REQUEST:
+            logger.warning("Slow request %s %s (%s): %s\n%s",
+                           request.method, request.path, pattern, timings.server_timing(),
+                           format_collapsed(samples or {}, SLOW_REQUEST_STACKS))
+
+        stats.record(pattern, timings)
+        stats.flush()
+
+        return response
@@ -1,6 +1,7 @@
 """
 Contains the cached model
 """
+import time
 import types
 
 from django.core.cache import cache
@@ -20,6 +21,8 @@ class CachedModel(BaseModel):
     MODEL_ATTR_CACHE_KEY = 'model-cache-attr-%s-%s-%s'
     FILTER_CACHE_KEY = 'filter-cache-%s-%s'
     FILTER_ITEM_LIST_CACHE_KEY = 'filter-cache-%s-%s-list'
+    MODEL_VERSION_CACHE_KEY = 'model-version-%s-%s'
+    CLASS_VERSION_CACHE_KEY = 'model-version-%s'
     # Set default timeout to max - 30 days. Invalidation should occur on save anyway.
     # Can be overridden by derived class
     MODEL_CACHE_TIMEOUT = 60 * 60 * 24 * 30
@@ -270,6 +273,71 @@ class CachedModel(BaseModel):
         """
         cache.delete(cls._get_cache_key(id))
 
+    @classmethod
+    def get_cache_version(cls, id=None, timeout=MODEL_CACHE_TIMEOUT):
+        """
+        Gets the version of the object with the given id, or of the whole class
+        if no id is given.  The version changes every time the object (or any
+        object of the class) is saved or deleted, so it can be used to tell
+        if data built from these objects is stale, ie. as an HTTP ETag.
+
+        RETURNS:
+            The version number
+
+        PARAMS:
+            cls(class):
+                The class of the object we're getting the version for
+            id(id (string or int)):
+                The id of the object we're getting the version for
+        """
+        key = cls._get_version_cache_key(id)
+        version = cache.get(key)
+        if version is None:
+            # Start from the current time, so a version that was evicted
+            # from the cache doesn't restart at a number that was used before
+            cache.add(key, int(time.time() * 1000), timeout)
+            version = cache.get(key)
+        return version
+
+    @classmethod
+    def _bump_cache_version(cls, id, timeout=MODEL_CACHE_TIMEOUT):
+        """
+        Changes the version of the object with the given id and of the class
+
+        RETURNS:
+            Void
+
+        PARAMS:
+            cls(class):
+                The class of the object we're changing the version for
+            id(id (string or int)):
+                The id of the object we're changing the version for
+        """
+        for key in (cls._get_version_cache_key(id), cls._get_version_cache_key()):
+            try:
+                cache.incr(key)
+            except ValueError:
+                # Key isn't in the cache anymore
+                cache.set(key, int(time.time() * 1000), timeout)
+
+    @classmethod
+    def _get_version_cache_key(cls, id=None):
+        """
+        Gets the cache key for the version of the item, or of the class if id is None.
+
+        RETURNS:
+            The cache key for the version
+
+        PARAMS:
+            cls(class):
+                The class of the object were getting the version cache key for
+            id(id (string or int)):
+                The id of the object we're getting the version cache key for
+        """
+        if id is None:
+            return CachedModel.CLASS_VERSION_CACHE_KEY % cls.__name__
+        return CachedModel.MODEL_VERSION_CACHE_KEY % (cls.__name__, id)
+
     def cache_remove(self):
         """ Removes this object instance from the cache """
         self.cache_remove_id(self.id)
@@ -349,14 +417,20 @@ class CachedModel(BaseModel):
         # Update cache with saved item
         cache.set(self.get_cache_key(), self, timeout)
 
+        self._bump_cache_version(self.id)
+
     def delete(self, *args, **kwargs):
         """
         Overrides default model delete method to remove a deleted item from the cache
         """
+        id = self.id
+
         super(CachedModel, self).delete(*args, **kwargs)
 
         self.invalidate_caches()
 
+        self._bump_cache_version(id)
+
     class Meta:
         abstract = True
 
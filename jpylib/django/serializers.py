@@ -4,12 +4,89 @@ Contains serializers for serializing data.
 import datetime
 import decimal
 import json
+from collections import OrderedDict
 
+from django.conf import settings
+from django.db import transaction
 from django.db.models import Model
 from django.db.models.query import ValuesQuerySet, QuerySet
 from django.utils.timezone import is_aware
 
-from jpylib.django.utils.models import model_to_dict
+from jpylib.django.utils.models import model_to_dict, queryset_to_dicts, iter_queryset_dicts
+
+
+def _encode_datetime(o):
+    r = o.isoformat()
+    if o.microsecond:
+        r = r[:23] + r[26:]
+    if r.endswith('+00:00'):
+        r = r[:-6] + 'Z'
+    return r
+
+
+def _encode_time(o):
+    if is_aware(o):
+        raise ValueError("JSON can't represent timezone-aware times.")
+    r = o.isoformat()
+    if o.microsecond:
+        r = r[:12]
+    return r
+
+
+# Maps the types JSON can't encode on its own to the method that converts them.
+# Subclasses use the handler of their closest base class in the table.
+JSON_TYPE_HANDLERS = {
+    ValuesQuerySet: list,
+    QuerySet: queryset_to_dicts,
+    Model: model_to_dict,
+    datetime.datetime: _encode_datetime,
+    datetime.date: lambda o: o.isoformat(),
+    datetime.time: _encode_time,
+    decimal.Decimal: str,
+}
+
+_handler_cache = {}
+
+
+def get_type_handler(cls):
+    """
+    Gets the handler from JSON_TYPE_HANDLERS for the type, walking its MRO
+    the first time the type is seen.
+
+    :param cls: The type of the object being encoded
+    :returns: The handler, or None if the type has no handler
+    """
+    try:
+        return _handler_cache[cls]
+    except KeyError:
+        pass
+
+    handler = None
+    for base in getattr(cls, '__mro__', (cls,)):
+        if base in JSON_TYPE_HANDLERS:
+            handler = JSON_TYPE_HANDLERS[base]
+            break
+
+    _handler_cache[cls] = handler
+    return handler
+
+
+def json_default(o):
+    """
+    Converts objects JSON can't encode on its own, ie. models, querysets,
+    dates and decimals.  Used as the default hook for every JSON backend.
+    """
+    handler = get_type_handler(type(o))
+    if handler is not None:
+        return handler(o)
+    elif callable(o):
+        try:
+            return o()
+        except:
+            # If we can't get data out of the callable,
+            # just return the function name
+            return o.__name__
+    raise TypeError(repr(o) + " is not JSON serializable")
 
 
 class JSONEncoder(json.JSONEncoder):
@@ -18,40 +95,262 @@ class JSONEncoder(json.JSONEncoder):
     addition to what the default django json encoder handles
     """
     def default(self, o):
+        return json_default(o)
+
+
+class StreamingJSONEncoder(JSONEncoder):
+    """
+    JSONEncoder that yields the JSON in fragments.  QuerySets are walked
+    with QuerySet.iterator() and encoded chunk_size rows at a time, so the
+    rows and their dicts are never all held in memory at once.  Everything
+    else is encoded the same as JSONEncoder.
+    """
+
+    def __init__(self, chunk_size=100, **kwargs):
+        super(StreamingJSONEncoder, self).__init__(**kwargs)
+        self.chunk_size = chunk_size
+
+    def iterencode(self, o, _one_shot=False):
+        if isinstance(o, QuerySet):
+            return self._iterencode_queryset(o)
+        elif isinstance(o, dict):
+            return self._iterencode_dict(o)
+        elif isinstance(o, (list, tuple)):
+            return self._iterencode_list(o)
+        return super(StreamingJSONEncoder, self).iterencode(o, _one_shot)
+
+    def _encode_one(self, o):
+        """
+        Encodes a value that contains no QuerySets in one shot, using the C encoder if available
+        """
+        return ''.join(super(StreamingJSONEncoder, self).iterencode(o, _one_shot=True))
+
+    def _iterencode_queryset(self, queryset):
+        if isinstance(queryset, ValuesQuerySet):
+            chunks = self._iter_values_chunks(queryset)
+        else:
+            chunks = iter_queryset_dicts(queryset, chunk_size=self.chunk_size)
+
+        yield '['
+        first = True
+        for chunk in chunks:
+            if not chunk:
+                continue
+            encoded = self.item_separator.join(self._encode_one(item) for item in chunk)
+            yield encoded if first else self.item_separator + encoded
+            first = False
+        yield ']'
+
+    def _iter_values_chunks(self, queryset):
+        chunk = []
+        for item in queryset.iterator():
+            chunk.append(item)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        yield chunk
+
+    def _iterencode_list(self, lst):
+        yield '['
+        for i, value in enumerate(lst):
+            if i:
+                yield self.item_separator
+            for fragment in self.iterencode(value):
+                yield fragment
+        yield ']'
+
+    def _iterencode_dict(self, dct):
+        yield '{'
+        first = True
+        for key, value in dct.iteritems():
+            if not isinstance(key, basestring):
+                if isinstance(key, (bool, type(None), int, long, float)):
+                    # Same conversions as the stdlib encoder, ie. True -> "true"
+                    key = self._encode_one(key)
+                elif self.skipkeys:
+                    continue
+                else:
+                    raise TypeError("key " + repr(key) + " is not a string")
+            if not first:
+                yield self.item_separator
+            first = False
+            yield self._encode_one(key) + self.key_separator
+            for fragment in self.iterencode(value):
+                yield fragment
+        yield '}'
+
+
+class SerializerBackend(object):
+    """
+    Base class for the libraries that can be used to serialize responses.
+    Every backend must support the same types as JSONEncoder, and JSON
+    backends must give the same output as JSONEncoder.
+    """
+    name = None
+    content_type = None
+
+    def dumps(self, o):
+        raise NotImplementedError()
+
+
+class JSONBackend(SerializerBackend):
+    content_type = 'application/json'
+
+
+class StdlibJSONBackend(JSONBackend):
+    """
+    Serializes using the stdlib json module, which uses its C encoder when available
+    """
+    name = 'json'
+
+    def dumps(self, o):
+        return json.dumps(o, cls=JSONEncoder)
+
+
+class SimpleJSONBackend(JSONBackend):
+    """
+    Serializes using simplejson and its C speedups.  simplejson's own
+    Decimal and namedtuple handling is turned off to match the stdlib output.
+    """
+    name = 'simplejson'
+
+    def __init__(self):
+        import simplejson
+        self.simplejson = simplejson
+
+    def dumps(self, o):
+        return self.simplejson.dumps(o,
+                                     default=json_default,
+                                     use_decimal=False,
+                                     namedtuple_as_object=False)
+
+    @classmethod
+    def has_speedups(cls):
+        try:
+            from simplejson import _speedups
+            return True
+        except ImportError:
+            return False
+
+
+JSON_BACKENDS = {
+    StdlibJSONBackend.name: StdlibJSONBackend,
+    SimpleJSONBackend.name: SimpleJSONBackend,
+}
+
+_backends = {}
+
+
+def get_json_backend(name=None):
+    """
+    Gets the JSON backend with the given name.  If no name is given, the
+    JSON_BACKEND setting is used, else the stdlib json module.  simplejson
+    is only used when it's asked for, so the output doesn't change with
+    what happens to be installed.
+
+    :param name: The name of the backend in JSON_BACKENDS
+    :type name: string
+    :returns: SerializerBackend instance
+    """
+    try:
+        return _backends[name]
+    except KeyError:
+        pass
 
-        if isinstance(o, ValuesQuerySet):
-            return list(o)
-        elif isinstance(o, QuerySet):
-            return [model_to_dict(m) for m in o]
-        elif isinstance(o, Model):
-            return model_to_dict(o)
-        elif isinstance(o, datetime.datetime):
-            r = o.isoformat()
-            if o.microsecond:
-                r = r[:23] + r[26:]
-            if r.endswith('+00:00'):
-                r = r[:-6] + 'Z'
-            return r
-        elif isinstance(o, datetime.date):
-            return o.isoformat()
-        elif isinstance(o, datetime.time):
-            if is_aware(o):
-                raise ValueError("JSON can't represent timezone-aware times.")
-            r = o.isoformat()
-            if o.microsecond:
-                r = r[:12]
-            return r
-        elif isinstance(o, decimal.Decimal):
-            return str(o)
-        elif callable(o):
+    backend_name = name or getattr(settings, 'JSON_BACKEND', StdlibJSONBackend.name)
+
+    backend = _backends[name] = JSON_BACKENDS[backend_name]()
+    return backend
+
+
+class MsgPackBackend(SerializerBackend):
+    """
+    Serializes to the compact binary msgpack format, converting models,
+    querysets, dates and decimals the same as JSONEncoder.
+    """
+    name = 'msgpack'
+    content_type = 'application/msgpack'
+
+    def __init__(self):
+        import msgpack
+        self.msgpack = msgpack
+
+    def dumps(self, o):
+        # Byte strings are packed as strings, as str is text in most of the code
+        return self.msgpack.packb(o, default=json_default, use_bin_type=False)
+
+
+# Maps the binary media types that can be asked for in the Accept header to their backend
+BINARY_BACKENDS = {
+    'application/msgpack': MsgPackBackend,
+    'application/x-msgpack': MsgPackBackend,
+}
+
+# Accepted media types that are served with the JSON backend
+JSON_MEDIA_TYPES = ('application/json', 'application/*', '*/*')
+
+_binary_backends = {}
+
+
+def _accept_quality(params):
+    """
+    Gets the q value from the parameters of an Accept header media range
+    """
+    for param in params.split(';'):
+        key, _, value = param.partition('=')
+        if key.strip() == 'q':
             try:
-                return o()
-            except:
-                # If we can't get data out of the callable,
-                # just return the function name
-                return o.__name__
+                return float(value)
+            except ValueError:
+                return 0
+    return 1
+
+
+def get_binary_backend(accept):
+    """
+    Gets the binary backend for the media type in the Accept header with the
+    highest q value.  application/json and */* count as asking for JSON, so
+    a binary backend is only used when it's preferred over them.  Backends
+    whose library isn't installed are skipped.  Equal q values go by the
+    order in the header.
+
+    :param accept: The value of the request's Accept header
+    :type accept: string
+    :returns: SerializerBackend instance, or None if JSON should be used
+    """
+    best = None
+    best_quality = 0
+    for media_range in accept.split(','):
+        media_type, _, params = media_range.partition(';')
+        media_type = media_type.strip().lower()
+
+        if media_type in JSON_MEDIA_TYPES:
+            backend = None
+        elif media_type in BINARY_BACKENDS:
+            backend = _get_binary_backend(BINARY_BACKENDS[media_type])
+            if backend is None:
+                continue
         else:
-            return super(JSONEncoder, self).default(o)
+            continue
+
+        quality = _accept_quality(params)
+        if quality > best_quality:
+            best, best_quality = backend, quality
+
+    return best
+
+
+def _get_binary_backend(backend_cls):
+    """
+    Gets the shared instance of the binary backend, or None if its library
+    isn't installed
+    """
+    if backend_cls not in _binary_backends:
+        try:
+            _binary_backends[backend_cls] = backend_cls()
+        except ImportError:
+            _binary_backends[backend_cls] = None
+    return _binary_backends[backend_cls]
 
 
 class DeserializedObject(object):
@@ -82,3 +381,122 @@ class DeserializedObject(object):
         self.wrapped.m2m_data = None
 
 
+def _model_key(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name.lower())
+
+
+def save_all(deserialized_objects, batch_size=500, using=None, save_models=None):
+    """
+    Saves deserialized objects in bulk.  Objects are grouped by model and
+    inserted with bulk_create, and their M2M relationships are written
+    straight into the through tables, instead of saving every object
+    and M2M accessor one at a time.  Like bulk_create, the bulk path
+    does not call save() or send signals.
+
+    Objects go through DeserializedObject.save instead if their model is in
+    save_models, their model uses multi-table inheritance, their primary
+    key already exists in the database, they have M2M data but no
+    primary key to write it for, or they have M2M data for a field with a
+    custom through model.
+
+    :param deserialized_objects: The objects from Django's deserializers, or
+                                 DeserializedObjects wrapping them
+    :type deserialized_objects: iterable
+    :param batch_size: The most objects to insert in one query
+    :type batch_size: int
+    :param using: The database alias to save to
+    :type using: string
+    :param save_models: Models, or 'app_label.modelname' strings, whose
+                        objects must go through the model's save path
+    :type save_models: list
+    :returns: The number of objects saved
+    """
+    save_models = set(m if isinstance(m, basestring) else _model_key(m)
+                      for m in (save_models or []))
+
+    # Group by model, keeping the order models first appear in so
+    # that foreign keys are saved before the objects that need them
+    by_model = OrderedDict()
+    for deserialized in deserialized_objects:
+        deserialized = getattr(deserialized, 'wrapped', deserialized)
+        by_model.setdefault(deserialized.object.__class__, []).append(deserialized)
+
+    count = 0
+    with transaction.commit_on_success(using=using):
+        for model, objs in by_model.iteritems():
+
+            if _model_key(model) in save_models or model._meta.parents:
+                to_save, to_create = objs, []
+            else:
+                to_save, to_create = _split_bulk_objects(model, objs, using)
+
+            for deserialized in to_save:
+                DeserializedObject(deserialized).save(using=using)
+
+            if to_create:
+                model._default_manager.db_manager(using).bulk_create(
+                    [deserialized.object for deserialized in to_create],
+                    batch_size=batch_size
+                )
+                _bulk_save_m2m(model, to_create, batch_size, using)
+
+            count += len(objs)
+
+    return count
+
+
+def _split_bulk_objects(model, objs, using):
+    """
+    Splits the objects into the ones that have to be saved one at a time
+    and the ones that can be inserted with bulk_create.
+    """
+    pks = [d.object.pk for d in objs if d.object.pk is not None]
+    existing = set()
+    for i in xrange(0, len(pks), 1000):
+        existing.update(model._default_manager.db_manager(using).filter(
+            pk__in=pks[i:i + 1000]).values_list('pk', flat=True))
+
+    to_save, to_create = [], []
+    for deserialized in objs:
+        pk = deserialized.object.pk
+        if (pk in existing or (pk is None and deserialized.m2m_data)
+                or _has_custom_through_data(model, deserialized)):
+            to_save.append(deserialized)
+        else:
+            to_create.append(deserialized)
+    return to_save, to_create
+
+
+def _has_custom_through_data(model, deserialized):
+    """
+    Checks if the object has M2M data for a field with a custom through
+    model, which can't be written as bare through rows since that would
+    skip the through model's own fields, defaults and save()
+    """
+    return any(not model._meta.get_field(accessor_name).rel.through._meta.auto_created
+               for accessor_name in (deserialized.m2m_data or {}))
+
+
+def _bulk_save_m2m(model, objs, batch_size, using):
+    """
+    Writes the M2M data of the objects as rows in the auto-created M2M
+    through tables
+    """
+    rows = {}
+    for deserialized in objs:
+        for accessor_name, object_list in (deserialized.m2m_data or {}).iteritems():
+            field = model._meta.get_field(accessor_name)
+            through = field.rel.through
+            source = through._meta.get_field(field.m2m_field_name()).attname
+            target = through._meta.get_field(field.m2m_reverse_field_name()).attname
+
+            rows.setdefault(through, []).extend(
+                through(**{source: deserialized.object.pk, target: getattr(related, 'pk', related)})
+                for related in object_list
+            )
+
+        # prevent a later call to save() from saving the m2m data twice.
+        deserialized.m2m_data = None
+
+    for through, through_rows in rows.iteritems():
+        through._default_manager.db_manager(using).bulk_create(through_rows, batch_size=batch_size)
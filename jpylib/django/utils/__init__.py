@@ -2,4 +2,5 @@
 Unified Django Utilities
 """
 from data_import import *
-from photo_upload import *
\ No newline at end of file
+from photo_upload import *
+from data_pipeline import *
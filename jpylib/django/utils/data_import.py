@@ -5,8 +5,13 @@ a data source into a model.
 import logging, datetime, time, traceback
 from decimal import Decimal
 
-from django.db import models
-from django.core.exceptions import MultipleObjectsReturned
+from django.conf import settings
+from django.db import models, connections, router, transaction
+from django.core.exceptions import MultipleObjectsReturned, ValidationError
+from django.utils import timezone
+
+from jpylib.data_struct import LRUCache
+from jpylib.date_parsing import parse_datetime, ISO_DATETIME_FORMAT, ISO_DATE_FORMAT
 
 
 logger = logging.getLogger(__name__)
@@ -37,7 +42,7 @@ def import_datetime(value):
         value = '1970-01-01T00:00:00.000Z'
         
     if isinstance(value, basestring):
-        value = datetime.datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")
+        value = parse_datetime(value[:19], ISO_DATETIME_FORMAT)
     
     return value
 
@@ -47,7 +52,7 @@ def import_date(value):
         value = '1970-01-01'
         
     if isinstance(value, basestring):
-        value = datetime.datetime.strptime(value[:10], "%Y-%m-%d")
+        value = parse_datetime(value[:10], ISO_DATE_FORMAT)
         
     return value
         
@@ -125,6 +130,424 @@ def import_value(model_obj, value, attr_name, field=None, **kwargs):
     
     return model_obj, transformed, field
 
+class BulkImporter(object):
+    """
+    Imports an iterable of source dicts into a model in batches.  Each row is
+    transformed with the same rules as import_value, new rows are inserted
+    with bulk_create and rows that already exist are written with batched
+    UPDATE statements, instead of one save() per row.
+
+    With track_changes, the transformed values are compared to the existing
+    row, unchanged rows are skipped and updates only write the dirty fields.
+    With dry_run, nothing is written and only the counts are kept.
+
+    Example:
+        importer = BulkImporter(Account, key='external_id', batch_size=1000,
+                                date_time_formatter='%Y-%m-%d %H:%M:%S')
+        importer.import_rows(rows)
+    """
+    
+    def __init__(self, model, key=None, batch_size=500, using=None, field_map=None,
+                 track_changes=False, dry_run=False, **kwargs):
+        """
+        PARAMS:
+            model(Model class):
+                The model we're importing the rows into
+            key(string):
+                The name of the field used to match source rows to rows that
+                already exist.  If not given, every row is inserted.
+            batch_size(int):
+                The number of rows to hold before flushing them to the database
+            using(string):
+                The database alias to write to.  Defaults to the router's choice.
+            field_map(dict):
+                Maps the keys of the source dicts to field names on the model.
+                Keys not in the map are used as the field name.
+            track_changes(bool):
+                If true, existing rows only write the fields whose values changed,
+                and rows where nothing changed are not written at all
+            dry_run(bool):
+                If true, rows are transformed and counted but nothing is written
+            kwargs:
+                The same flags that import_value takes, ie. formatters,
+                positive, lookup fields, fail_missing_fk and disallow_fk_update.
+                A ForeignKeyCache can be passed as fk_cache to share it between
+                imports, else a new one is used for this import.
+        """
+        self.model = model
+        self.key = key
+        self.batch_size = batch_size
+        self.using = using or router.db_for_write(model)
+        self.field_map = field_map or {}
+        self.track_changes = track_changes
+        self.dry_run = dry_run
+        self.kwargs = kwargs
+        self.kwargs.setdefault('fk_cache', ForeignKeyCache(using=self.using))
+        
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.not_set = {}
+        self.errors = []
+        
+        self._pending = []
+        self._fields = {}
+        self._current_m2m = {}
+        
+    def import_rows(self, rows):
+        """
+        Imports all of the rows, flushing every batch_size rows.
+        
+        RETURNS:
+            This importer, so the created/updated/unchanged/errors counts can be checked
+            
+        PARAMS:
+            rows(iterable of dicts):
+                The source rows to import
+        """
+        for row in rows:
+            self.add(row)
+        self.flush()
+        return self
+    
+    def add(self, row):
+        """
+        Queues a source row for import, flushing if the batch is full.
+        """
+        self._pending.append(row)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+            
+    def get_field(self, name):
+        """
+        Gets the field for the given field name, caching the lookup for the
+        rest of the import.  Returns None for fields that do not exist or
+        that can never be set, like the primary key.
+        """
+        if name not in self._fields:
+            self._fields[name] = get_import_field(self.model, name)
+        return self._fields[name]
+    
+    def transform_row(self, model_obj, row):
+        """
+        Transforms and sets the values of a source row on the model instance.
+        M2M values are not set, since the instance may not be saved yet.
+        If tracking changes on an existing instance, only the fields whose
+        values changed are returned.
+        
+        RETURNS:
+            The list of fields that were set, and a dict of M2M field names 
+            to the list of related objects to set once the object is saved
+            
+        PARAMS:
+            model_obj(Model Instance):
+                The instance we're setting the values on
+            row(dict):
+                The source row, keyed by field name
+        """
+        fields = []
+        m2m = {}
+        track_changes = self.track_changes and model_obj.pk is not None
+        
+        for attr_name, value in row.iteritems():
+            
+            field = self.get_field(attr_name)
+            if field is None:
+                continue
+            
+            try:
+                transformed = self.transform_value(field, model_obj, value)
+            except DoNotSetException:
+                logger.debug("Attribute name %s not set for model %s", attr_name, model_obj)
+                self.not_set[attr_name] = self.not_set.get(attr_name, 0) + 1
+                continue
+            
+            if type(transformed) == list: ### M2M fields work differently, set after saving
+                if not track_changes or self._m2m_changed(model_obj, attr_name, transformed):
+                    m2m[attr_name] = transformed
+            else:
+                current = getattr(model_obj, field.attname)
+                setattr(model_obj, attr_name, transformed)
+                if not track_changes or (_comparable_value(field, getattr(model_obj, field.attname)) != 
+                                         _comparable_value(field, current)):
+                    fields.append(field)
+                
+        return fields, m2m
+    
+    def _m2m_changed(self, model_obj, attr_name, related_objs):
+        """
+        Checks if the related objects differ from the ones currently set on the instance,
+        using the pks prefetched for the batch when there are any
+        """
+        if attr_name in self._current_m2m:
+            current = self._current_m2m[attr_name].get(model_obj.pk, set())
+        else:
+            current = set(getattr(model_obj, attr_name).values_list('pk', flat=True))
+        return current != set(related_obj.pk for related_obj in related_objs)
+    
+    def transform_value(self, field, model_obj, value):
+        """
+        Transforms a single source value for the field.  Override to change how
+        values are converted, ie. when they were already converted elsewhere.
+        """
+        return _transform_value_for_field(field, model_obj, value, **self.kwargs)
+    
+    def flush(self):
+        """
+        Writes all of the queued rows to the database.  If this is a dry run,
+        the rows are only counted.
+        """
+        rows, self._pending = self._pending, []
+        if not rows:
+            return
+        
+        rows = self._dedupe_rows([self._map_row(row) for row in rows])
+        existing = self._get_existing(rows)
+        self._prefetch_related(rows)
+        self._prefetch_m2m(existing, rows)
+        
+        to_create = []
+        to_update = []
+        m2m_data = []
+        
+        for row in rows:
+            
+            model_obj = existing.get(self._get_key_value(row))
+            is_new = model_obj is None
+            if is_new:
+                model_obj = self.model()
+                
+            try:
+                fields, m2m = self.transform_row(model_obj, row)
+            except ImportFKMissingException, ex:
+                logger.warning("Row %s could not be imported into model %s.", row, self.model)
+                self.errors.append((row, ex))
+                continue
+            
+            if not is_new and not fields and not m2m and self.track_changes:
+                self.unchanged += 1
+                continue
+            
+            if self.dry_run:
+                if is_new:
+                    self.created += 1
+                else:
+                    self.updated += 1
+                continue
+            
+            if is_new and m2m:
+                # bulk_create doesn't give us primary keys back, so rows with
+                # M2M relationships have to be saved on their own
+                model_obj.save(using=self.using)
+                self.created += 1
+            elif is_new:
+                to_create.append(model_obj)
+            else:
+                to_update.append((model_obj, fields))
+                
+            if m2m:
+                m2m_data.append((model_obj, m2m))
+                
+        if to_create:
+            self.model._default_manager.db_manager(self.using).bulk_create(to_create)
+            self.created += len(to_create)
+            
+        if to_update:
+            self._update(to_update)
+            self.updated += len(to_update)
+            
+        for model_obj, m2m in m2m_data:
+            for attr_name, related_objs in m2m.iteritems():
+                attr = getattr(model_obj, attr_name)
+                attr.clear() # clear old relationships so we can add all the existing ones
+                attr.add(*related_objs)
+                
+    def _prefetch_related(self, rows):
+        """
+        Resolves all of the FK and M2M values in the batch with one query per related field
+        """
+        fk_cache = self.kwargs.get('fk_cache')
+        if fk_cache is None or self.kwargs.get('disallow_fk_update', False):
+            return
+        
+        values = {}
+        for row in rows:
+            for attr_name, value in row.iteritems():
+                field = self.get_field(attr_name)
+                if isinstance(field, models.ManyToManyField) and isinstance(value, basestring):
+                    values.setdefault(field, set()).update(value.split(','))
+                elif isinstance(field, models.ForeignKey) and value:
+                    values.setdefault(field, set()).add(value)
+                    
+        for field, field_values in values.iteritems():
+            fk_cache.prefetch(field.rel.to, _get_lookup_field(field, **self.kwargs), field_values)
+                
+    def _prefetch_m2m(self, existing, rows):
+        """
+        Gets the pks currently set on the existing instances for each M2M field in the
+        batch, with one query on the through table per field, so tracking changes
+        doesn't query every row
+        """
+        self._current_m2m = {}
+        if not self.track_changes or not existing:
+            return
+        
+        attr_names = set()
+        for row in rows:
+            attr_names.update(row.iterkeys())
+        
+        pks = [obj.pk for obj in existing.itervalues()]
+        for attr_name in attr_names:
+            field = self.get_field(attr_name)
+            if not isinstance(field, models.ManyToManyField):
+                continue
+            
+            source_name = field.m2m_field_name()
+            target_name = field.m2m_reverse_field_name()
+            current = {}
+            links = field.rel.through._default_manager.using(self.using).filter(
+                **{source_name + '__in': pks}).values_list(source_name, target_name)
+            for source_pk, target_pk in links:
+                current.setdefault(source_pk, set()).add(target_pk)
+            self._current_m2m[attr_name] = current
+                
+    def _map_row(self, row):
+        """
+        Renames the keys of the source row to model field names using field_map
+        """
+        if not self.field_map:
+            return row
+        return dict((self.field_map.get(k, k), v) for k, v in row.iteritems())
+    
+    def _get_key_value(self, row):
+        """
+        Gets the value of the key field from the row, as it's stored in the model
+        """
+        if not self.key or self.key not in row:
+            return None
+        return self.model._meta.get_field(self.key).to_python(row[self.key])
+    
+    def _dedupe_rows(self, rows):
+        """
+        Drops all but the last row for each key value in the batch, so a key
+        that shows up twice is only created or updated once, with the last
+        row's values.  Rows without a key value are all kept.
+        """
+        if not self.key:
+            return rows
+        
+        keys = [self._get_key_value(row) for row in rows]
+        last = dict((key, i) for i, key in enumerate(keys) if key is not None)
+        return [row for i, (row, key) in enumerate(zip(rows, keys))
+                if key is None or last[key] == i]
+    
+    def _get_existing(self, rows):
+        """
+        Gets all of the rows in the batch that already exist in one query
+        
+        RETURNS:
+            Dict of key value to model instance
+        """
+        if not self.key:
+            return {}
+        
+        keys = set(self._get_key_value(row) for row in rows)
+        keys.discard(None)
+        if not keys:
+            return {}
+        
+        attname = self.model._meta.get_field(self.key).attname
+        existing = self.model._default_manager.using(self.using).filter(**{self.key + '__in': keys})
+        return dict((getattr(obj, attname), obj) for obj in existing)
+    
+    def _update(self, to_update):
+        """
+        Writes the changed fields of existing rows.  Rows that changed the same
+        fields are grouped, and on Postgres each group is written with a single
+        UPDATE ... FROM (VALUES ...) statement.
+        
+        PARAMS:
+            to_update(list of tuples):
+                Each tuple is the model instance and the list of fields set on it
+        """
+        opts = self.model._meta
+        auto_now = [f for f in opts.fields if getattr(f, 'auto_now', False)]
+        connection = connections[self.using]
+        
+        groups = {}
+        for model_obj, fields in to_update:
+            for field in auto_now:
+                # queryset updates skip save(), so keep auto_now fields current here
+                field.pre_save(model_obj, False)
+            fields = set(fields) | set(auto_now)
+            if fields:
+                groups.setdefault(tuple(sorted(fields)), []).append(model_obj)
+            
+        with transaction.commit_on_success(using=self.using):
+            for fields, objs in groups.iteritems():
+                
+                if connection.vendor == 'postgresql' and all(f in opts.local_fields for f in fields):
+                    self._update_values(connection, fields, objs)
+                else:
+                    for model_obj in objs:
+                        values = dict((f.attname, getattr(model_obj, f.attname)) for f in fields)
+                        self.model._default_manager.using(self.using).filter(
+                            pk=model_obj.pk
+                        ).update(**values)
+                        
+    def _update_values(self, connection, fields, objs):
+        """
+        Updates all of the given objects in one statement using a VALUES list
+        """
+        opts = self.model._meta
+        qn = connection.ops.quote_name
+        columns = [opts.pk] + list(fields)
+        
+        def cast(field):
+            if isinstance(field, models.AutoField):
+                return 'integer'
+            return field.db_type(connection)
+        
+        row_sql = '(%s)' % ', '.join('%%s::%s' % cast(f) for f in columns)
+        
+        sql = 'UPDATE %s SET %s FROM (VALUES %s) AS "v" (%s) WHERE %s.%s = "v".%s' % (
+            qn(opts.db_table),
+            ', '.join('%s = "v".%s' % (qn(f.column), qn(f.column)) for f in fields),
+            ', '.join([row_sql] * len(objs)),
+            ', '.join(qn(f.column) for f in columns),
+            qn(opts.db_table), qn(opts.pk.column), qn(opts.pk.column),
+        )
+        
+        params = []
+        for model_obj in objs:
+            params.extend(f.get_db_prep_save(getattr(model_obj, f.attname), connection=connection)
+                          for f in columns)
+            
+        connection.cursor().execute(sql, params)
+        
+def get_import_field(model_info, field_name):
+    """
+    Gets the field to import a value into for the given field name.
+    
+    RETURNS:
+        The Field object, or None if the field does not exist or can
+        never be set by an import, like the primary key.
+        
+    PARAMS:
+        model_info(Model Class or Model Instance):
+            The model we're importing into
+        field_name(string):
+            The name of the field
+    """
+    try:
+        return get_field_with_name(model_info, field_name)
+    except models.FieldDoesNotExist:
+        logger.info('Field %s on model %s not found. Skipping it for this import.', 
+                    field_name, model_info)
+    except DoNotSetException:
+        pass
+    return None
+
 def field_is_number(model_obj, attr_name, field=None, raise_unfound=False):
     """
     Given the model and the field name, determines if the field is a number field.
@@ -230,6 +653,25 @@ def _field_null_and_default(field, value):
         if not field.null and field.default is not models.NOT_PROVIDED:
             raise DoNotSetException("Null value on non-null field w/default value")
 
+def _comparable_value(field, value):
+    """
+    Converts a field value the way it would be saved, so values of different
+    types that save the same, like a datetime and a date on a DateField or a
+    Decimal and a float on a FloatField, compare as equal.  Naive datetimes are
+    made aware when time zone support is on.  Values that can't be converted
+    are returned as they are.
+    """
+    if isinstance(value, time.struct_time):
+        value = datetime.time(value.tm_hour, value.tm_min, value.tm_sec)
+    try:
+        value = field.to_python(value)
+        if (isinstance(value, datetime.datetime) and settings.USE_TZ 
+                and timezone.is_naive(value)):
+            value = timezone.make_aware(value, timezone.get_default_timezone())
+        return field.get_prep_value(value)
+    except (ValidationError, TypeError, ValueError):
+        return value
+
 def _check_update_fk(**kwargs):
     """
     Checks to see if there is a flag in kwargs that does not allow setting foreign keys.
@@ -238,6 +680,18 @@ def _check_update_fk(**kwargs):
     if kwargs.get('disallow_fk_update', False):
         raise DoNotSetException("Setting Foreign Keys is not allowed in this import")
     
+def _check_positive(field, value, floor, **kwargs):
+    """
+    Checks to see if there is a flag in kwargs that requires the value of a number
+    field to be positive. If there is, and the value is negative, floor is returned.
+    The flag can be set for all fields with 'positive' or per field with
+    '<attname>_positive', the same as the import_integer and import_decimal methods.
+    """
+    positive = kwargs.get(field.attname + '_positive', kwargs.get('positive', False))
+    if positive and value is not None and value < 0:
+        return floor
+    return value
+    
 def _transform_value_for_field(field, model_obj, value_to_transform, **kwargs):
     """
     Takes a value from salesforce, along with a model's field information and transforms
@@ -288,6 +742,8 @@ def _transform_value_for_field(field, model_obj, value_to_transform, **kwargs):
             
         if isinstance(value_to_transform, basestring):
             value_to_transform = int(Decimal(value_to_transform))
+            
+        value_to_transform = _check_positive(field, value_to_transform, 0, **kwargs)
         
     elif isinstance(field, models.DateTimeField):
 
@@ -298,13 +754,12 @@ def _transform_value_for_field(field, model_obj, value_to_transform, **kwargs):
 
         if isinstance(value_to_transform, basestring):
             
-            datetime_format = "%Y-%m-%dT%H:%M:%S"
+            datetime_format = ISO_DATETIME_FORMAT
             datetime_format = kwargs.get('date_time_formatter', datetime_format)
             datetime_format = kwargs.get(field.attname + '_date_time_formatter', 
                                          datetime_format)
             
-            value_to_transform = datetime.datetime.strptime(value_to_transform [:19], 
-                                                            datetime_format)
+            value_to_transform = parse_datetime(value_to_transform[:19], datetime_format)
                 
     elif isinstance(field, models.DateField):
             
@@ -315,11 +770,11 @@ def _transform_value_for_field(field, model_obj, value_to_transform, **kwargs):
                 
         if isinstance(value_to_transform, basestring):
             
-            date_format = "%Y-%m-%d"
+            date_format = ISO_DATE_FORMAT
             date_format = kwargs.get('date_formatter', date_format)
             date_format = kwargs.get(field.attname + '_date_formatter', date_format)
                 
-            value_to_transform = datetime.datetime.strptime(value_to_transform[:10], date_format)
+            value_to_transform = parse_datetime(value_to_transform[:10], date_format)
         
     elif isinstance(field, models.TimeField):
             
@@ -346,6 +801,8 @@ def _transform_value_for_field(field, model_obj, value_to_transform, **kwargs):
 
         if isinstance(value_to_transform, basestring):
             value_to_transform = Decimal(value_to_transform)
+            
+        value_to_transform = _check_positive(field, value_to_transform, 0.00, **kwargs)
                         
     elif isinstance(field, models.BooleanField) or\
          isinstance(field, models.NullBooleanField):
@@ -385,10 +842,12 @@ def _tranform_foreign_key(value_to_transform, field, model_obj, **kwargs):
     """
     Transforms the value for a foreign key to something that can be set on the object.
     Attempts to see if the object was already created. If not, attempts to get the object
-    from the database.
+    from the database.  If an fk_cache is given in kwargs, the lookup goes through
+    the cache instead of querying for every value.
          
     RETURNS: 
-        The created foreign key object if found, else None if not found
+        The related object, or the list of related objects for an M2M field.
+        Raises DoNotSetException if an FK can't be resolved and shouldn't fail.
          
     PARAMS:
         value_to_transform(string):
@@ -400,9 +859,7 @@ def _tranform_foreign_key(value_to_transform, field, model_obj, **kwargs):
     """
     if value_to_transform:
             
-        lookup_field = 'id'
-        if field.attname + '_lookup_field' in kwargs:
-            lookup_field = kwargs[field.attname + '_lookup_field']
+        lookup_field = _get_lookup_field(field, **kwargs)
             
         # Get related model information            
         related_model = field.rel.to
@@ -421,14 +878,15 @@ def _tranform_foreign_key(value_to_transform, field, model_obj, **kwargs):
             for val in value_to_transform:
                 
                 try:
-                    related_obj = related_model.objects.get(**{lookup_field:val})
+                    related_obj = _get_related_object(related_model, lookup_field, val, **kwargs)
                     all_objs.append(related_obj)
                     
                 except models.ObjectDoesNotExist:
             
                     try:
-                        _fk_missing_fail(value_to_transform, 
-                                         "Too many objects matched", 
+                        _fk_missing_fail(field,
+                                         val, 
+                                         "No objects matched", 
                                          False, 
                                          **kwargs)
                     except DoNotSetException:
@@ -437,7 +895,8 @@ def _tranform_foreign_key(value_to_transform, field, model_obj, **kwargs):
                 except MultipleObjectsReturned:
                     try:
             
-                        _fk_missing_fail(value_to_transform, 
+                        _fk_missing_fail(field,
+                                         val, 
                                          "Too many objects matched", 
                                          False, 
                                          **kwargs)
@@ -450,23 +909,20 @@ def _tranform_foreign_key(value_to_transform, field, model_obj, **kwargs):
         else: # Regular FK or 1To1
                 
             try:
-                related_obj = related_model.objects.get(**{lookup_field:value_to_transform})
+                related_obj = _get_related_object(related_model, 
+                                                  lookup_field, 
+                                                  value_to_transform, 
+                                                  **kwargs)
                 logger.debug("Foreign key found in database, returning object")
                 return related_obj
                     
+            # The DoNotSetException from _fk_missing_fail is left to the caller,
+            # so the field keeps its current value instead of being set to None
             except models.ObjectDoesNotExist:
-                
-                try:
-                    _fk_missing_fail(value_to_transform, "Too many objects matched", True, **kwargs)
-                except DoNotSetException:
-                    pass
+                _fk_missing_fail(field, value_to_transform, "No objects matched", True, **kwargs)
                 
             except MultipleObjectsReturned:
-                
-                try:
-                    _fk_missing_fail(value_to_transform, "Too many objects matched", True, **kwargs)
-                except DoNotSetException:
-                    pass
+                _fk_missing_fail(field, value_to_transform, "Too many objects matched", True, **kwargs)
     else:
             
         # If there is a null reference, and we don't allow for nulls to a foreignkey field
@@ -479,6 +935,127 @@ def _tranform_foreign_key(value_to_transform, field, model_obj, **kwargs):
         else:
             # if there is no data and it's nullable just don't set it
             raise DoNotSetException("Null value on null field w/default null value")
+            
+def _get_lookup_field(field, **kwargs):
+    """
+    Gets the field used to look up related objects for the FK or M2M field.
+    Defaults to id, can be overridden with the <attname>_lookup_field kwarg.
+    """
+    return kwargs.get(field.attname + '_lookup_field', 'id')
+
+def _get_related_object(related_model, lookup_field, value, **kwargs):
+    """
+    Gets the related object for an FK value.  Goes through the fk_cache in kwargs
+    if there is one, else queries the database.  Raises ObjectDoesNotExist or
+    MultipleObjectsReturned the same as a get() call.
+    """
+    fk_cache = kwargs.get('fk_cache')
+    if fk_cache is not None:
+        return fk_cache.get(related_model, lookup_field, value)
+    
+    return related_model.objects.get(**{lookup_field:value})
+    
+class ForeignKeyCache(object):
+    """
+    Caches the related objects resolved for FK and M2M values during an import,
+    so the same related id isn't looked up for every row.  Values can be
+    prefetched for a whole batch with one filter(lookup_field__in=...) query
+    per related model.  Pass it in the import kwargs as fk_cache.
+    """
+    
+    def __init__(self, max_size=10000, using=None):
+        """
+        PARAMS:
+            max_size(int):
+                The most lookup values to hold, least recently used are dropped first
+            using(string):
+                The database alias to query.  Defaults to the router's choice.
+        """
+        self.using = using
+        self._cache = LRUCache(max_size)
+        
+    def prefetch(self, related_model, lookup_field, values):
+        """
+        Resolves all of the values that are not already cached in one query.
+        Lookups that span relations (contain __) can't be matched back to
+        their values, so those are left for get() to resolve one at a time.
+        
+        PARAMS:
+            related_model(Model class):
+                The model the FK points to
+            lookup_field(string):
+                The field on related_model the values are matched against
+            values(iterable):
+                The FK values from the source rows
+        """
+        if '__' in lookup_field:
+            return
+        
+        missing = set()
+        for value in values:
+            if not value:
+                continue
+            try:
+                value = self._to_python(related_model, lookup_field, value)
+            except (ValidationError, ValueError, TypeError):
+                # Leave bad values for get() so they fail the same as an uncached lookup
+                continue
+            if (related_model, lookup_field, value) not in self._cache:
+                missing.add(value)
+                
+        if not missing:
+            return
+        
+        found = dict((value, []) for value in missing)
+        attname = self._get_lookup(related_model, lookup_field).attname
+        
+        for related_obj in related_model._default_manager.db_manager(self.using).filter(
+                **{lookup_field + '__in': missing}):
+            found.setdefault(getattr(related_obj, attname), []).append(related_obj)
+            
+        for value, related_objs in found.iteritems():
+            self._cache[(related_model, lookup_field, value)] = related_objs
+            
+    def get(self, related_model, lookup_field, value):
+        """
+        Gets the related object for the value, querying for it if it isn't cached.
+        Raises ObjectDoesNotExist or MultipleObjectsReturned the same as a get() call.
+        """
+        try:
+            value = self._to_python(related_model, lookup_field, value)
+        except (ValidationError, ValueError, TypeError):
+            pass
+            
+        key = (related_model, lookup_field, value)
+        related_objs = self._cache.get(key)
+        
+        if related_objs is None:
+            related_objs = list(related_model._default_manager.db_manager(self.using).filter(
+                **{lookup_field: value})[:2])
+            self._cache[key] = related_objs
+            
+        if not related_objs:
+            raise related_model.DoesNotExist("%s matching %s=%s does not exist." % 
+                                             (related_model.__name__, lookup_field, value))
+        elif len(related_objs) > 1:
+            raise MultipleObjectsReturned("Multiple %s matched %s=%s." % 
+                                          (related_model.__name__, lookup_field, value))
+        
+        return related_objs[0]
+    
+    def _get_lookup(self, related_model, lookup_field):
+        if lookup_field == 'pk':
+            return related_model._meta.pk
+        return related_model._meta.get_field(lookup_field)
+    
+    def _to_python(self, related_model, lookup_field, value):
+        """
+        Converts the value to the type stored in the lookup field, so source
+        strings match the values read back from the database
+        """
+        if '__' in lookup_field:
+            return value
+        return self._get_lookup(related_model, lookup_field).to_python(value)
                 
 def _fk_missing_fail(field, value_to_transform, msg, check_null, **kwargs):
     """
@@ -0,0 +1,247 @@
+"""
+This module contains a pipeline that imports source rows into a model using
+a process pool.  Rows are read in chunks, the values are converted in the
+worker processes, and the converted chunks are written by a single
+BulkImporter in the calling process.
+"""
+import logging
+import multiprocessing
+from collections import deque
+from itertools import islice
+
+from django.db import models, connections
+
+from .data_import import (BulkImporter, DoNotSetException, get_import_field,
+                          _transform_value_for_field)
+
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['ChunkReport', 'ImportPipeline', 'iter_chunks']
+
+
+def iter_chunks(rows, chunk_size):
+    """
+    Reads the rows in lists of chunk_size rows, without reading the whole iterable.
+
+    >>> list(iter_chunks(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+    """
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class ChunkReport(object):
+    """
+    The outcome of importing one chunk of rows.
+
+    not_set is a dict of field name to the number of values that were not set
+    because of a DoNotSetException.  errors is a list of the rows that could
+    not be imported along with the reason, ie. a missing foreign key.
+    """
+
+    def __init__(self, index, rows=0):
+        self.index = index
+        self.rows = rows
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.not_set = {}
+        self.errors = []
+
+    def add_not_set(self, attr_name, count=1):
+        self.not_set[attr_name] = self.not_set.get(attr_name, 0) + count
+
+    def __repr__(self):
+        return '<ChunkReport %s: %s rows, %s created, %s updated, %s unchanged, %s errors>' % (
+            self.index, self.rows, self.created, self.updated, self.unchanged, len(self.errors))
+
+
+def _is_relation(field):
+    return isinstance(field, (models.ForeignKey, models.ManyToManyField))
+
+
+def _convert_chunk(task):
+    """
+    Converts the values of a chunk of rows in a worker process.  Foreign keys
+    are left as they are, since they need the database to be resolved.
+
+    RETURNS:
+        The list of converted rows and the ChunkReport for the conversion
+
+    PARAMS:
+        task(tuple):
+            The chunk index, model app label, model name, key field,
+            field map, kwargs for _transform_value_for_field and the rows
+    """
+    index, app_label, model_name, key, field_map, kwargs, rows = task
+
+    model = models.get_model(app_label, model_name)
+    report = ChunkReport(index, len(rows))
+    fields = {}
+    converted = []
+
+    for row in rows:
+
+        if field_map:
+            row = dict((field_map.get(k, k), v) for k, v in row.iteritems())
+
+        out = {}
+        try:
+            for attr_name, value in row.iteritems():
+
+                if attr_name not in fields:
+                    fields[attr_name] = get_import_field(model, attr_name)
+                field = fields[attr_name]
+
+                if field is None or _is_relation(field):
+                    if field is not None or attr_name == key:
+                        out[attr_name] = value
+                    continue
+
+                try:
+                    out[attr_name] = _transform_value_for_field(field, model, value, **kwargs)
+                except DoNotSetException:
+                    report.add_not_set(attr_name)
+
+        except (ValueError, TypeError, ArithmeticError), ex:
+            logger.warning("Row %s could not be converted for model %s.", row, model_name)
+            report.errors.append((row, repr(ex)))
+            continue
+
+        converted.append(out)
+
+    return converted, report
+
+
+class _ConvertedImporter(BulkImporter):
+    """
+    BulkImporter for rows whose values were already converted by _convert_chunk.
+    Only the foreign keys still need to be transformed.
+    """
+
+    def transform_value(self, field, model_obj, value):
+        if _is_relation(field):
+            return super(_ConvertedImporter, self).transform_value(field, model_obj, value)
+        return value
+
+
+class ImportPipeline(object):
+    """
+    Imports source rows into a model using a process pool for the value
+    conversion and a single writer for the database.  At most max_pending
+    chunks are converting at once, so a slow database holds back the reader
+    instead of piling converted rows up in memory.
+
+    Example:
+        pipeline = ImportPipeline(Account, key='external_id', chunk_size=2000)
+        for report in pipeline.run(rows):
+            if report.errors:
+                ...
+    """
+
+    def __init__(self, model, key=None, chunk_size=1000, processes=None,
+                 max_pending=None, using=None, field_map=None, **kwargs):
+        """
+        PARAMS:
+            model(Model class):
+                The model we're importing the rows into
+            key(string):
+                The name of the field used to match source rows to existing rows
+            chunk_size(int):
+                The number of rows sent to a worker, and written, at once
+            processes(int):
+                The number of worker processes.  Defaults to the cpu count.
+            max_pending(int):
+                The most chunks that can be read but not yet written.
+                Defaults to twice the number of processes.
+            using(string):
+                The database alias to write to
+            field_map(dict):
+                Maps the keys of the source dicts to field names on the model
+            kwargs:
+                The same flags that BulkImporter takes, ie. track_changes and dry_run
+        """
+        self.model = model
+        self.key = key
+        self.chunk_size = chunk_size
+        self.processes = processes or multiprocessing.cpu_count()
+        self.max_pending = max_pending or self.processes * 2
+        self.field_map = field_map
+        self.kwargs = kwargs
+
+        self.importer = _ConvertedImporter(model, key=key, batch_size=chunk_size,
+                                           using=using, **kwargs)
+
+    def run(self, rows):
+        """
+        Imports all of the rows.
+
+        RETURNS:
+            The list of ChunkReports, in the order the chunks were read
+
+        PARAMS:
+            rows(iterable of dicts):
+                The source rows to import
+        """
+        opts = self.model._meta
+        # Everything but the fk cache can be sent to the workers
+        worker_kwargs = dict((k, v) for k, v in self.kwargs.iteritems() if k != 'fk_cache')
+
+        # Don't let the workers inherit open database connections
+        for connection in connections.all():
+            connection.close()
+
+        reports = []
+        pending = deque()
+        pool = multiprocessing.Pool(self.processes)
+
+        try:
+            for index, chunk in enumerate(iter_chunks(rows, self.chunk_size)):
+
+                task = (index, opts.app_label, opts.object_name, self.key,
+                        self.field_map, worker_kwargs, chunk)
+                pending.append(pool.apply_async(_convert_chunk, (task,)))
+
+                if len(pending) >= self.max_pending:
+                    reports.append(self._write(*pending.popleft().get()))
+
+            while pending:
+                reports.append(self._write(*pending.popleft().get()))
+
+            pool.close()
+
+        except:
+            pool.terminate()
+            raise
+
+        finally:
+            pool.join()
+
+        return reports
+
+    def _write(self, converted, report):
+        """
+        Writes a converted chunk and adds the writer's outcome to its report
+        """
+        importer = self.importer
+        created, updated, unchanged = importer.created, importer.updated, importer.unchanged
+        errors = len(importer.errors)
+        not_set = dict(importer.not_set)
+
+        importer.import_rows(converted)
+
+        report.created = importer.created - created
+        report.updated = importer.updated - updated
+        report.unchanged = importer.unchanged - unchanged
+        report.errors.extend((row, repr(ex)) for row, ex in importer.errors[errors:])
+        for attr_name, count in importer.not_set.iteritems():
+            if count > not_set.get(attr_name, 0):
+                report.add_not_set(attr_name, count - not_set.get(attr_name, 0))
+
+        logger.debug("Imported %r", report)
+        return report
@@ -1,6 +1,9 @@
 """
 Contains helper methods for working with Django models.
 """
+from django.db.models import ForeignKey, ManyToManyField
+from django.db.models.query import prefetch_related_objects
+
 from jpylib.functional import item_split, filter_all
 
 
@@ -21,6 +24,144 @@ def split_field_list(fields):
     return (output[0], output[2]) if output else (None, None)
 
 
+def _as_key(fields):
+    """
+    Turns a field list argument into something hashable for the plan cache
+    """
+    return tuple(fields) if fields else None
+
+
+# The kinds of entries in a serializer plan
+_VALUE, _FK, _M2M, _M2M_FOLLOW = range(4)
+
+_plan_cache = {}
+
+
+class SerializerPlan(object):
+    """
+    The precomputed steps to turn instances of a model into dicts for a
+    given set of model_to_dict arguments.  The field list splitting and
+    field filtering are done once when the plan is built, so serializing
+    an instance is only a loop over the field accessors.  Use
+    get_serializer_plan to get the cached plan for the arguments.
+    """
+
+    def __init__(self, model, fields=None, exclude=None, only_editable=False, follow_fk=None):
+        fields_curr, fields_next = split_field_list(fields)
+        exclude_curr, exclude_next = split_field_list(exclude)
+        fk_curr, fk_next = split_field_list(follow_fk)
+
+        opts = model._meta
+
+        self.model = model
+        self.entries = []
+        self._related_lookups = None
+
+        for f in opts.fields + opts.many_to_many:
+            if only_editable and not f.editable:
+                continue
+            if fields_curr and not f.name in fields_curr:
+                continue
+            if exclude_curr and f.name in exclude_curr:
+                continue
+
+            follow = fk_curr and f.name in fk_curr
+            nested = None
+            if follow and isinstance(f, (ForeignKey, ManyToManyField)):
+                nested = get_serializer_plan(f.rel.to,
+                                             fields=fields_next,
+                                             exclude=exclude_next,
+                                             only_editable=only_editable,
+                                             follow_fk=fk_next)
+
+            if isinstance(f, ManyToManyField):
+                kind = _M2M_FOLLOW if nested else _M2M
+            elif isinstance(f, ForeignKey) and nested:
+                kind = _FK
+            else:
+                kind = _VALUE
+
+            self.entries.append((f.name, kind, f.value_from_object, nested))
+
+    def to_dict(self, instance):
+        """
+        Serializes the instance using this plan.
+
+        :param instance: An instance of the plan's model
+        :return: The dict of the instance's data
+        """
+        data = {}
+        for name, kind, value_from_object, nested in self.entries:
+            if kind == _VALUE:
+                data[name] = value_from_object(instance)
+            elif kind == _FK:
+                related = getattr(instance, name)
+                data[name] = nested.to_dict(related) if related is not None else None
+            elif instance.pk is None:
+                # If the object doesn't have a primary key yet, just use an empty
+                # list for its m2m fields. Calling f.value_from_object will raise
+                # an exception.
+                data[name] = []
+            elif kind == _M2M_FOLLOW:
+                data[name] = [nested.to_dict(obj) for obj in value_from_object(instance)]
+            else:
+                data[name] = [obj.pk for obj in value_from_object(instance)]
+        return data
+
+    def related_lookups(self):
+        """
+        Gets the select_related and prefetch_related lookups that load everything
+        this plan reads from related models, so serializing a queryset costs a
+        constant number of queries.  Followed FK chains are selected, anything
+        through an M2M is prefetched.
+
+        :return: The list of select_related lookups and the list of prefetch_related lookups
+        """
+        if self._related_lookups is None:
+            self._related_lookups = self._build_related_lookups('', False)
+        return self._related_lookups
+
+    def _build_related_lookups(self, prefix, via_m2m):
+        select = []
+        prefetch = []
+        for name, kind, _, nested in self.entries:
+            if kind == _VALUE:
+                continue
+
+            path = prefix + name
+            if kind == _FK and not via_m2m:
+                select.append(path)
+            else:
+                prefetch.append(path)
+
+            if nested:
+                nested_select, nested_prefetch = nested._build_related_lookups(
+                    path + '__', via_m2m or kind != _FK)
+                select.extend(nested_select)
+                prefetch.extend(nested_prefetch)
+
+        return select, prefetch
+
+
+def get_serializer_plan(model, fields=None, exclude=None, only_editable=False, follow_fk=None):
+    """
+    Gets the cached SerializerPlan for the model and model_to_dict arguments,
+    building it the first time it's requested.
+
+    :param model: The model class the plan serializes
+    :return: The SerializerPlan
+    """
+    key = (model, _as_key(fields), _as_key(exclude), bool(only_editable), _as_key(follow_fk))
+    plan = _plan_cache.get(key)
+    if plan is None:
+        plan = _plan_cache[key] = SerializerPlan(model,
+                                                 fields=key[1],
+                                                 exclude=key[2],
+                                                 only_editable=key[3],
+                                                 follow_fk=key[4])
+    return plan
+
+
 def model_to_dict(instance,
                   fields=None,
                   exclude=None,
@@ -47,46 +188,78 @@ def model_to_dict(instance,
     :param follow_fk: Specifies when to follow foreign key fields to
                       allow for retrieving related data
     """
-    fields_curr, fields_next = split_field_list(fields)
-    exclude_curr, exclude_next = split_field_list(exclude)
-    fk_curr, fk_next = split_field_list(follow_fk)
-
-    opts = instance._meta
-
-    data = {}
-    for f in opts.fields + opts.many_to_many:
-        if only_editable and not f.editable:
-            continue
-        if fields_curr and not f.name in fields_curr:
-            continue
-        if exclude_curr and f.name in exclude_curr:
-            continue
-        if isinstance(f, ManyToManyField):
-            # If the object doesn't have a primary key yet, just use an empty
-            # list for its m2m fields. Calling f.value_from_object will raise
-            # an exception.
-            if instance.pk is None:
-                data[f.name] = []
-            elif fk_curr and f.name in fk_curr:
-                data[f.name] = [
-                    model_to_dict(obj,
-                                  fields=fields_next,
-                                  exclude=exclude_next,
-                                  only_editable=only_editable,
-                                  follow_fk=fk_next)
-                    for obj in f.value_from_object(instance)]
-            else:
-                data[f.name] = [
-                    obj.pk for obj in f.value_from_object(instance)
-                ]
-        if isinstance(f, ForeignKey) and fk_curr and f.name in fk_curr:
-            data[f.name] = model_to_dict(getattr(instance, f.name),
-                                         fields=fields_next,
-                                         exclude=exclude_next,
-                                         only_editable=only_editable,
-                                         follow_fk=fk_next)
-
-        else:
-            data[f.name] = f.value_from_object(instance)
-    return data
+    return get_serializer_plan(instance.__class__,
+                               fields=fields,
+                               exclude=exclude,
+                               only_editable=only_editable,
+                               follow_fk=follow_fk).to_dict(instance)
+
+
+def queryset_to_dicts(queryset,
+                      fields=None,
+                      exclude=None,
+                      only_editable=False,
+                      follow_fk=None):
+    """
+    Returns a list of the model_to_dict data for every instance in the
+    queryset.  The followed foreign keys and M2M fields are loaded with
+    select_related and prefetch_related first, instead of one query per
+    relation per instance.  Takes the same arguments as model_to_dict.
+
+    :param queryset: The QuerySet of model instances to serialize
+    :return: list of dicts
+    """
+    plan = get_serializer_plan(queryset.model,
+                               fields=fields,
+                               exclude=exclude,
+                               only_editable=only_editable,
+                               follow_fk=follow_fk)
+
+    select, prefetch = plan.related_lookups()
+    if select:
+        queryset = queryset.select_related(*select)
+    if prefetch:
+        queryset = queryset.prefetch_related(*prefetch)
+
+    return [plan.to_dict(obj) for obj in queryset]
+
+
+def iter_queryset_dicts(queryset,
+                        chunk_size=100,
+                        fields=None,
+                        exclude=None,
+                        only_editable=False,
+                        follow_fk=None):
+    """
+    Same as queryset_to_dicts, but walks the queryset with
+    QuerySet.iterator() and yields the dicts in lists of chunk_size.
+    Since iterator() skips prefetch_related, the prefetching is done
+    for each chunk.
+
+    :param queryset: The QuerySet of model instances to serialize
+    :param chunk_size: The number of instances to load and serialize at a time
+    :return: generator of lists of dicts
+    """
+    plan = get_serializer_plan(queryset.model,
+                               fields=fields,
+                               exclude=exclude,
+                               only_editable=only_editable,
+                               follow_fk=follow_fk)
+
+    select, prefetch = plan.related_lookups()
+    if select:
+        queryset = queryset.select_related(*select)
+
+    chunk = []
+    for obj in queryset.iterator():
+        chunk.append(obj)
+        if len(chunk) >= chunk_size:
+            if prefetch:
+                prefetch_related_objects(chunk, prefetch)
+            yield [plan.to_dict(o) for o in chunk]
+            chunk = []
 
+    if chunk:
+        if prefetch:
+            prefetch_related_objects(chunk, prefetch)
+        yield [plan.to_dict(o) for o in chunk]
@@ -1,12 +1,32 @@
+import copy
+import hashlib
 import json
 import logging
+from calendar import timegm
 
 from django.views import generic as base_views
-from django.http import HttpResponse, HttpResponseServerError
+from django.core.cache import cache
+from django.core import exceptions as core_exceptions
+from django.core.urlresolvers import resolve, Resolver404
+from django.db import connections
+from django.http import (HttpResponse, HttpResponseServerError, HttpResponseNotModified,
+                         StreamingHttpResponse, QueryDict)
+from django.utils.cache import get_cache_key, learn_cache_key, patch_vary_headers
+from django.utils.datastructures import MultiValueDict
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+from django.utils.importlib import import_module
 
 from django.conf import settings
 
-from .serializers import JSONEncoder
+from .compression import choose_encoding, compress, compress_iter
+from .serializers import JSONEncoder, StreamingJSONEncoder, get_json_backend, get_binary_backend
+
+try:
+    import gevent
+    from gevent import monkey
+    from gevent.pool import Pool
+except ImportError:
+    gevent = None
 
 logger = logging.getLogger(__name__)
 
@@ -47,6 +67,43 @@ class AngularIndex(base_views.TemplateView):
 
 class AjaxView(base_views.View):
 
+    # Set to True to stream all responses from this view, see ajax_response
+    stream_response = False
+
+    # Name of the JSON backend to serialize with, see serializers.get_json_backend
+    json_backend = None
+
+    # Allow clients to ask for a binary format like msgpack in the Accept header
+    allow_binary_response = True
+
+    # Seconds to cache serialized GET responses for, keyed by URL and the
+    # version key.  Only used if get_version_key returns a version.
+    response_cache_timeout = None
+
+    # Request headers the cached responses are also keyed on, and added to
+    # their Vary header, along with any the handler's response varies on.
+    # By default responses are cached per session or credentials, since they
+    # usually depend on request.user.  Set to () for responses that are the
+    # same for everyone, or key them on what they depend on in get_version_key.
+    response_cache_vary = ('Cookie', 'Authorization')
+
+    RESPONSE_CACHE_KEY = 'ajax-response-%s'
+
+    # Set to True to compress responses in-process with gzip or brotli,
+    # negotiated through the Accept-Encoding header
+    compress_responses = False
+
+    # Smallest body in bytes worth compressing. Streaming responses are
+    # always compressed, since their size isn't known up front.
+    compress_min_size = 1024
+
+    # The gzip level or brotli quality. None uses the defaults tuned for JSON.
+    compress_level = None
+
+    # Most loaders load_concurrent runs at once, and the default seconds each one gets
+    loader_pool_size = 10
+    loader_timeout = None
+
     def dispatch(self, request, *args, **kwargs):
         # Try to dispatch to the right method; if a method doesn't exist,
         # defer to the error handler. Also defer to the error handler if the
@@ -68,24 +125,506 @@ class AjaxView(base_views.View):
         self.request = request
         self.args = args
         self.kwargs = kwargs
-        return handler(request, *args, **kwargs)
+        if request.method in ('GET', 'HEAD') and handler != self.http_method_not_allowed:
+            response = self.conditional_response(handler, request, *args, **kwargs)
+        else:
+            response = handler(request, *args, **kwargs)
+        return self.compress_response(request, response)
+
+    def compress_response(self, request, response):
+        """
+        Compresses the response body if compress_responses is set and the
+        client accepts gzip or brotli.  Streaming responses are compressed
+        chunk by chunk as they are sent.
+        """
+        if (not self.compress_responses or response.status_code != 200
+                or response.has_header('Content-Encoding')):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+        encoding = choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return response
+
+        if getattr(response, 'streaming', False):
+            response.streaming_content = compress_iter(response.streaming_content,
+                                                       encoding,
+                                                       self.compress_level)
+        else:
+            if len(response.content) < self.compress_min_size:
+                return response
+            response.content = compress(response.content, encoding, self.compress_level)
+            response['Content-Length'] = str(len(response.content))
+
+        response['Content-Encoding'] = encoding
+        if response.has_header('ETag') and not response['ETag'].startswith('W/'):
+            # The compressed body is no longer byte for byte the one the ETag was made for
+            response['ETag'] = 'W/' + response['ETag']
+        return response
+
+    def get_version_key(self, request, *args, **kwargs):
+        """
+        Override to return a cheap value that changes whenever the response
+        would change, ie. CachedModel.get_cache_version() of the models the
+        response is built from.  It's used to build the ETag, and to key the
+        response cache.  Returning None turns off conditional responses.
+        """
+        return None
+
+    def get_last_modified(self, request, *args, **kwargs):
+        """
+        Override to return the datetime the response's data last changed,
+        to support Last-Modified/If-Modified-Since.  None turns it off.
+        """
+        return None
+
+    def make_etag(self, version):
+        """
+        Builds the ETag for the version key.  Includes the content type,
+        since the same data can be serialized to more than one format.
+        """
+        content_type = self.get_serializer_backend().content_type
+        return '"%s"' % hashlib.md5(repr(version) + content_type).hexdigest()
+
+    def conditional_response(self, handler, request, *args, **kwargs):
+        """
+        Calls the handler unless the client already has the current version of
+        the response, in which case a 304 is returned without calling the
+        handler or serializing anything.  If response_cache_timeout is set,
+        serialized responses are also cached for the version.
+        """
+        version = self.get_version_key(request, *args, **kwargs)
+        last_modified = self.get_last_modified(request, *args, **kwargs)
+        if version is None and last_modified is None:
+            return handler(request, *args, **kwargs)
+
+        etag = self.make_etag(version) if version is not None else None
+        if last_modified is not None:
+            last_modified = timegm(last_modified.utctimetuple())
+
+        if self._not_modified(request, etag, last_modified):
+            response = HttpResponseNotModified()
+        elif etag and self.response_cache_timeout:
+            response = self._cached_response(etag, handler, request, *args, **kwargs)
+        else:
+            response = handler(request, *args, **kwargs)
 
-    def ajax_response(self, context, status=None, **kwargs):
-        content_type = kwargs.get('content_type', 'application/json')
+        if response.status_code in (200, 304):
+            if etag:
+                response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+        return response
+
+    def _not_modified(self, request, etag, last_modified):
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match and etag:
+            return if_none_match.strip() == '*' or etag.strip('"') in parse_etags(if_none_match)
+
+        if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        if if_modified_since and last_modified is not None:
+            return last_modified <= if_modified_since
+
+        return False
+
+    def _cached_response(self, etag, handler, request, *args, **kwargs):
+        """
+        Gets the response from the cache, or calls the handler and caches its
+        response with its headers.  Keys are built the same way as Django's
+        cache middleware, from the URL and the values of the request headers
+        the response varies on, with the ETag in the prefix.
+        """
+        key_prefix = self.RESPONSE_CACHE_KEY % etag.strip('"')
+        key = get_cache_key(request, key_prefix, request.method, cache=cache)
+
+        cached = cache.get(key) if key is not None else None
+        if cached is not None:
+            content, headers = cached
+            response = HttpResponse(content)
+            for header, value in headers:
+                response[header] = value
+            return response
+
+        response = handler(request, *args, **kwargs)
+        if (response.status_code == 200 and not getattr(response, 'streaming', False)
+                and not response.cookies):
+            patch_vary_headers(response, self.response_cache_vary)
+            key = learn_cache_key(request, response, self.response_cache_timeout, key_prefix, cache=cache)
+            cache.set(key, (response.content, response.items()), self.response_cache_timeout)
+        return response
+
+    def ajax_response(self, context, status=None, stream=None, **kwargs):
+        """
+        Serializes the context into the response.  If stream is true (or
+        stream_response is set on the view and JSON was accepted), the context
+        is encoded with StreamingJSONEncoder into a StreamingHttpResponse, so
+        large QuerySets are written out in chunks.  Streamed responses are
+        always JSON.  Errors while streaming can't change the
+        status that was already sent, so they are logged and the body is cut off.
+        """
+        backend = self.get_serializer_backend()
+        if stream is None:
+            stream = self.stream_response and backend.content_type == 'application/json'
+        if stream and context is not None:
+            # serialize_iter always writes JSON, whatever format was accepted
+            response = StreamingHttpResponse(self.serialize_iter(context),
+                                             status=status,
+                                             content_type=kwargs.pop('content_type', 'application/json'),
+                                             **kwargs)
+            if self.allow_binary_response:
+                patch_vary_headers(response, ('Accept',))
+            return response
+        content_type = kwargs.pop('content_type', backend.content_type)
         try:
             output = self.serialize(context) if context is not None else None
             if status is None and context is None:
                 status = 204
-            return HttpResponse(output, status=status, content_type=content_type, **kwargs)
+            response = HttpResponse(output, status=status, content_type=content_type, **kwargs)
+            if self.allow_binary_response:
+                patch_vary_headers(response, ('Accept',))
+            return response
         except Exception as ex:
             logger.exception("An exception occurred serializing the response.")
             err = dict(error=ex.message)
             return HttpResponseServerError(self.serialize(err), content_type=content_type)
 
+    def get_serializer_backend(self):
+        """
+        Gets the backend to serialize the response with.  If binary responses
+        are allowed and the request's Accept header asks for a binary format
+        that is installed, that backend is used, else the JSON backend.
+        """
+        request = getattr(self, 'request', None)
+        if self.allow_binary_response and request is not None:
+            backend = get_binary_backend(request.META.get('HTTP_ACCEPT', ''))
+            if backend is not None:
+                return backend
+        return get_json_backend(self.json_backend)
+
     def serialize(self, context):
-        return json.dumps(context, cls=JSONEncoder)
+        return self.get_serializer_backend().dumps(context)
+
+    def load_concurrent(self, loaders, context=None, timeout=None, pool_size=None):
+        """
+        Runs independent data loaders concurrently on a bounded greenlet pool
+        and merges their results into the context.  With psycogreen, DB
+        queries in different loaders run at the same time, so the loaders
+        take about as long as the slowest one.  Without gevent they run one
+        after another.
+
+        A loader that raises or times out doesn't affect the others; its
+        key gets the value returned by on_loader_error.
+
+        :param loaders: dict of context key to a callable that takes no
+                        arguments, or to a (callable, timeout) tuple
+        :type loaders: dict
+        :param context: The context to merge the results into
+        :type context: dict
+        :param timeout: Default seconds each loader gets. Defaults to loader_timeout
+        :type timeout: float
+        :param pool_size: Most loaders to run at once. Defaults to loader_pool_size
+        :type pool_size: int
+        :returns: The context with the loaded values
+        """
+        context = {} if context is None else context
+        timeout = self.loader_timeout if timeout is None else timeout
+
+        loaders = dict(
+            (name, loader if isinstance(loader, tuple) else (loader, timeout))
+            for name, loader in loaders.iteritems()
+        )
+
+        if gevent is None:
+            for name, (loader, _) in loaders.iteritems():
+                try:
+                    context[name] = loader()
+                except Exception as ex:
+                    context[name] = self.on_loader_error(name, ex)
+            return context
+
+        pool = Pool(pool_size or self.loader_pool_size)
+        greenlets = dict(
+            (name, pool.spawn(self._run_loader, name, loader, loader_timeout))
+            for name, (loader, loader_timeout) in loaders.iteritems()
+        )
+        pool.join()
+
+        for name, greenlet in greenlets.iteritems():
+            context[name] = greenlet.value
+        return context
+
+    def on_loader_error(self, name, exception):
+        """
+        Called when a loader from load_concurrent raises or times out.
+        Returns the value to put in the context for the loader.
+        """
+        logger.exception("Loader %s failed for view %s: %r", name, self.__class__.__name__, exception)
+        return None
+
+    def _run_loader(self, name, loader, timeout):
+        timer = gevent.Timeout(timeout)
+        try:
+            with timer:
+                return loader()
+        except gevent.Timeout as ex:
+            if ex is not timer:
+                # Not this loader's timeout, ie. one around the whole request
+                raise
+            return self.on_loader_error(name, ex)
+        except Exception as ex:
+            return self.on_loader_error(name, ex)
+        finally:
+            if monkey.is_module_patched('thread'):
+                # Connections are greenlet-local when threading is patched, so
+                # close the ones this loader opened instead of leaking them
+                for connection in connections.all():
+                    connection.close()
+
+    def serialize_iter(self, context):
+        try:
+            for fragment in StreamingJSONEncoder().iterencode(context):
+                yield fragment
+        except Exception:
+            logger.exception("An exception occurred streaming the response.")
 
 
 class TemplateAjaxView(AjaxView, base_views.TemplateView):
     pass
 
+
+
+class BatchAjaxView(AjaxView):
+    """
+    Runs many AjaxView calls in one request.  POST a JSON list of
+    sub-requests, or {"requests": [...], "parallel": true}, where each
+    sub-request looks like:
+
+        {"id": "user", "method": "GET", "path": "/api/user/",
+         "ajax_method": "profile", "params": {"full": 1}, "body": {...}}
+
+    Each one is resolved by URL and dispatched to its view with a copy of
+    this request, so it goes through the same AjaxView.dispatch routing
+    and has the same user and session.  The process_view methods of the
+    middleware in MIDDLEWARE_CLASSES run before each sub-request's view,
+    so view-level access checks still apply.  The response is a list with
+    the id, status and deserialized body of each sub-response, in the
+    order they were given.
+
+    Only AjaxView views can be targeted, or if allowed_views is set, only
+    the views it lists.  Batches can't target a BatchAjaxView, so they
+    can't be nested.
+    """
+
+    # Most sub-requests allowed in one batch
+    max_batch_size = 50
+
+    # Run the sub-requests concurrently with load_concurrent by default
+    parallel = False
+
+    # URL names or dotted view paths sub-requests may target.  If None,
+    # any AjaxView that isn't a BatchAjaxView can be targeted.
+    allowed_views = None
+
+    # The process_view methods of the middleware, loaded on first use
+    _view_middleware = None
+
+    # Headers that shouldn't be passed on to sub-requests, since the
+    # sub-responses have to be plain JSON to be combined
+    SUB_REQUEST_EXCLUDED_META = ('HTTP_ACCEPT', 'HTTP_ACCEPT_ENCODING', 'HTTP_IF_NONE_MATCH',
+                                 'HTTP_IF_MODIFIED_SINCE', 'CONTENT_LENGTH', 'CONTENT_TYPE')
+
+    def post_ajax(self, request, *args, **kwargs):
+        try:
+            batch = json.loads(request.body)
+        except ValueError:
+            return self.ajax_response(dict(error="Batch body must be JSON."), status=400)
+
+        parallel = self.parallel
+        if isinstance(batch, dict):
+            parallel = batch.get('parallel', parallel)
+            batch = batch.get('requests')
+
+        if not isinstance(batch, list):
+            return self.ajax_response(dict(error="Batch must be a list of requests."), status=400)
+        if len(batch) > self.max_batch_size:
+            return self.ajax_response(
+                dict(error="Batch can have at most %s requests." % self.max_batch_size),
+                status=400
+            )
+
+        if parallel:
+            results = self.load_concurrent(
+                dict((i, (lambda spec=spec: self.run_sub_request(request, spec)))
+                     for i, spec in enumerate(batch))
+            )
+            results = [results[i] for i in xrange(len(batch))]
+        else:
+            results = [self.run_sub_request(request, spec) for spec in batch]
+
+        for i, result in enumerate(results):
+            if result is None:
+                # The sub-request's greenlet died without a result
+                result = results[i] = dict(status=500, body=None)
+            result['id'] = batch[i].get('id', i) if isinstance(batch[i], dict) else i
+
+        return self.ajax_response(results)
+
+    post = post_ajax
+
+    def on_loader_error(self, name, exception):
+        """
+        Gives a sub-request that timed out in load_concurrent a 504, and
+        one that failed any other way a 500
+        """
+        super(BatchAjaxView, self).on_loader_error(name, exception)
+        if gevent is not None and isinstance(exception, gevent.Timeout):
+            return dict(status=504, body=None)
+        return dict(status=500, body=dict(error=getattr(exception, 'message', None) or repr(exception)))
+
+    def run_sub_request(self, request, spec):
+        """
+        Dispatches one sub-request to its view.
+
+        :param request: The batch request
+        :param spec: The sub-request's method, path, ajax_method, params and body
+        :type spec: dict
+        :returns: dict of the sub-response's status and deserialized body
+        """
+        if not isinstance(spec, dict) or not spec.get('path'):
+            return dict(status=400, body=dict(error="Sub-request needs a path."))
+
+        try:
+            match = resolve(spec['path'])
+        except Resolver404:
+            return dict(status=404, body=None)
+
+        if not self.is_allowed_target(match):
+            return dict(status=403, body=dict(error="Sub-request can't target this view."))
+
+        try:
+            sub_request = self.build_sub_request(request, spec)
+
+            response = None
+            for process_view in self.get_view_middleware():
+                response = process_view(sub_request, match.func, match.args, match.kwargs)
+                if response is not None:
+                    break
+
+            if response is None:
+                response = match.func(sub_request, *match.args, **match.kwargs)
+            if hasattr(response, 'render') and callable(response.render):
+                response.render()
+
+            if getattr(response, 'streaming', False):
+                content = ''.join(response.streaming_content)
+            else:
+                content = response.content
+
+            try:
+                body = json.loads(content) if content else None
+            except ValueError:
+                body = content
+
+            return dict(status=response.status_code, body=body)
+
+        except Exception as ex:
+            logger.exception("An exception occurred running batch sub-request %s.", spec['path'])
+            return dict(status=500, body=dict(error=getattr(ex, 'message', None) or repr(ex)))
+
+    def is_allowed_target(self, match):
+        """
+        Checks if a sub-request can be dispatched to the resolved view
+
+        :param match: The ResolverMatch of the sub-request's path
+        :returns: True if the view can be targeted
+        """
+        view_class = _get_view_class(match.func)
+        if view_class is not None and issubclass(view_class, BatchAjaxView):
+            return False
+
+        if self.allowed_views is not None:
+            view_path = '%s.%s' % (match.func.__module__, match.func.__name__)
+            return match.url_name in self.allowed_views or view_path in self.allowed_views
+
+        return view_class is not None and issubclass(view_class, AjaxView)
+
+    @classmethod
+    def get_view_middleware(cls):
+        """
+        Gets the process_view methods of the middleware in MIDDLEWARE_CLASSES,
+        loaded the same way Django's handler loads them
+        """
+        if cls._view_middleware is None:
+            view_middleware = []
+            for middleware_path in settings.MIDDLEWARE_CLASSES:
+                module_path, _, class_name = middleware_path.rpartition('.')
+                try:
+                    middleware = getattr(import_module(module_path), class_name)()
+                except core_exceptions.MiddlewareNotUsed:
+                    continue
+                if hasattr(middleware, 'process_view'):
+                    view_middleware.append(middleware.process_view)
+            cls._view_middleware = view_middleware
+        return cls._view_middleware
+
+    def build_sub_request(self, request, spec):
+        """
+        Builds a copy of the batch request for the sub-request.
+        """
+        method = spec.get('method', 'GET').upper()
+
+        params = QueryDict('', mutable=True)
+        for key, value in (spec.get('params') or {}).iteritems():
+            if isinstance(value, list):
+                params.setlist(key, [unicode(v) for v in value])
+            else:
+                params[key] = unicode(value)
+        if spec.get('ajax_method'):
+            params['ajax_method'] = spec['ajax_method']
+
+        sub_request = copy.copy(request)
+        # Drop the lazily built attributes copied from the batch request
+        for attr in ('_request', '_post', '_files', '_body', '_stream', '_read_started'):
+            sub_request.__dict__.pop(attr, None)
+
+        sub_request.method = method
+        sub_request.path = sub_request.path_info = spec['path']
+
+        sub_request.META = dict((k, v) for k, v in request.META.iteritems()
+                                if k not in self.SUB_REQUEST_EXCLUDED_META)
+        sub_request.META['REQUEST_METHOD'] = method
+        sub_request.META['PATH_INFO'] = spec['path']
+        sub_request.META['HTTP_X_REQUESTED_WITH'] = 'XMLHttpRequest'
+
+        if method == 'GET':
+            sub_request.GET = params
+            sub_request._post = QueryDict('')
+            sub_request.META['QUERY_STRING'] = params.urlencode()
+        else:
+            sub_request.GET = QueryDict('')
+            sub_request._post = params
+            sub_request.META['QUERY_STRING'] = ''
+        sub_request._files = MultiValueDict()
+
+        body = spec.get('body')
+        sub_request._body = json.dumps(body, cls=JSONEncoder) if body is not None else ''
+        if body is not None:
+            sub_request.META['CONTENT_TYPE'] = 'application/json'
+
+        return sub_request
+
+
+def _get_view_class(func):
+    """
+    Gets the class a class-based view function was made from with as_view,
+    or None for function views
+    """
+    view_class = getattr(func, 'view_class', None)
+    if view_class is None:
+        # as_view doesn't record the class before Django 1.9, but it's in the closure
+        for cell in getattr(func, 'func_closure', None) or ():
+            contents = cell.cell_contents
+            if isinstance(contents, type) and issubclass(contents, base_views.View):
+                return contents
+    return view_class
@@ -0,0 +1,77 @@
+"""
+Contains helpers for files that are written and read back in later, like
+caches and stats.  They're kept in a directory private to the user instead
+of the shared temp directory, so other users can't plant or replace them.
+"""
+import logging
+import os
+import stat
+import tempfile
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_private_dir(*names):
+    """
+    Gets a directory under jpylib's directory in the user's cache directory,
+    $XDG_CACHE_HOME or ~/.cache.  It isn't created.
+
+    :param names: The path of the directory under jpylib's directory
+    :type names: strings
+    :returns: string
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'jpylib', *names)
+
+
+def check_private_dir(path, create=True, owned=True):
+    """
+    Checks that only the owner of the directory can write to it
+
+    :param path: The directory
+    :type path: string
+    :param create: Create the directory, with only the user allowed in, if it's missing
+    :type create: bool
+    :param owned: Also check that the directory belongs to the user.  Turn
+                  off to read files another user wrote, ie. as root.
+    :type owned: bool
+    :returns: False if the directory doesn't exist and couldn't be created,
+              or if it's another user's or others can write to it
+    """
+    try:
+        if create and not os.path.isdir(path):
+            os.makedirs(path, 0700)
+        info = os.stat(path)
+    except OSError:
+        logger.warning("Could not create the directory %s", path)
+        return False
+
+    if (owned and info.st_uid != os.getuid()) or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        logger.warning("Not using %s, since other users can write to it", path)
+        return False
+    return True
+
+
+def write_atomic(path, data):
+    """
+    Writes the file through a temp file in the same directory that's renamed
+    over it, so readers never see a partly written file.  Each writer gets
+    its own temp file, so processes writing at once don't clobber each other.
+
+    :param path: The file to write
+    :type path: string
+    :param data: The contents of the file
+    :type data: string
+    :raises: IOError, OSError
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix='.%s.' % os.path.basename(path), suffix='.tmp',
+                                    dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            tmp_file.write(data)
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
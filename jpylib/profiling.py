@@ -0,0 +1,161 @@
+"""
+Contains helpers for building sampled stack profiles.  Profiles are kept
+in the collapsed stack format read by flamegraph.pl and speedscope: one
+line per unique stack, with its frames from the root down joined by ';',
+followed by the number of times the stack was sampled.
+"""
+import gc
+import sys
+import time
+
+try:
+    import greenlet
+    from gevent import monkey as gevent_monkey
+except ImportError:
+    greenlet = None
+
+# Roots of the sampled stacks, to tell running and waiting code apart
+THREAD_ROOT = '[thread]'
+GREENLET_ROOT = '[greenlet]'
+
+
+def frame_label(frame):
+    """
+    Gets the label of a frame in a collapsed stack.  Line numbers are left
+    out, so samples anywhere in a function add up to the same stack.
+    """
+    code = frame.f_code
+    return '%s (%s)' % (code.co_name, code.co_filename)
+
+
+def collapse_stack(frame):
+    """
+    Gets the stack leading to the frame as a collapsed stack string
+
+    :param frame: The innermost frame of the stack
+    :returns: The frame labels from the outermost frame in, joined by ';'
+    """
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return ';'.join(labels)
+
+
+def format_collapsed(counts, limit=None):
+    """
+    Formats the sampled stacks as collapsed stack lines, most sampled first
+
+    :param counts: dict of collapsed stack to the number of samples
+    :type counts: dict
+    :param limit: The most stacks to include
+    :type limit: int
+    :returns: string
+    """
+    stacks = sorted(counts.iteritems(), key=lambda item: item[1], reverse=True)
+    if limit:
+        stacks = stacks[:limit]
+    return '\n'.join('%s %d' % (stack, count) for stack, count in stacks)
+
+
+def _original(module, name):
+    """
+    Gets the unpatched function if gevent monkey patched it, so the
+    profiler gets a real thread that runs even while greenlets hog the CPU
+    """
+    if greenlet is not None:
+        return gevent_monkey.get_original(module, name)
+    return getattr(sys.modules.get(module) or __import__(module), name)
+
+
+class SamplingProfiler(object):
+    """
+    Statistical profiler that samples the stacks of every thread, and with
+    gevent every switched-out greenlet, from a background thread.  The
+    stacks are counted in collapsed stack form for flame graphs.
+
+    Finding the switched-out greenlets walks all of the gc objects, which is
+    slow with a large heap, so they are only sampled every greenlet_interval
+    seconds.  Their stacks are counted once for every sample taken since the
+    last walk, to keep the proportions with the thread stacks.
+    """
+
+    def __init__(self, interval=0.005, greenlet_interval=1.0):
+        """
+        :param interval: Seconds between samples
+        :type interval: float
+        :param greenlet_interval: Seconds between samples of the switched-out greenlets
+        :type greenlet_interval: float
+        """
+        self.interval = interval
+        self.greenlet_interval = greenlet_interval
+        self.counts = {}
+        self.samples = 0
+        self._greenlet_samples = 0
+        self._greenlets_sampled_at = 0
+        self.running = False
+        self.started = None
+        self._thread_id = None
+        # Bumped on every start, so a stopped sampler thread never resumes
+        self._generation = 0
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.started = time.time()
+        self._greenlets_sampled_at = self.started
+        self._greenlet_samples = 0
+        self._generation += 1
+        _original('thread', 'start_new_thread')(self._run, (self._generation,))
+
+    def stop(self):
+        """
+        Stops sampling
+
+        :returns: dict of collapsed stack to sample count
+        """
+        self.running = False
+        return self.counts
+
+    def reset(self):
+        self.counts = {}
+        self.samples = 0
+        self._greenlet_samples = 0
+
+    def _run(self, generation):
+        self._thread_id = _original('thread', 'get_ident')()
+        sleep = _original('time', 'sleep')
+        while self.running and generation == self._generation:
+            self.sample()
+            sleep(self.interval)
+
+    def _add(self, root, frame, weight=1):
+        stack = root + ';' + collapse_stack(frame)
+        self.counts[stack] = self.counts.get(stack, 0) + weight
+
+    def sample(self):
+        self.samples += 1
+        self._greenlet_samples += 1
+
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id != self._thread_id:
+                self._add(THREAD_ROOT, frame)
+
+        now = time.time()
+        if greenlet is not None and now - self._greenlets_sampled_at >= self.greenlet_interval:
+            weight, self._greenlet_samples = self._greenlet_samples, 0
+            self._greenlets_sampled_at = now
+            for obj in gc.get_objects():
+                # gr_frame is only set while a greenlet is switched out
+                if isinstance(obj, greenlet.greenlet) and obj.gr_frame is not None:
+                    self._add(GREENLET_ROOT, obj.gr_frame, weight)
+
+    def dump(self, path):
+        """
+        Writes the sampled stacks to the file in collapsed stack format
+        """
+        with open(path, 'w') as profile_file:
+            profile_file.write(format_collapsed(self.counts))
+            profile_file.write('\n')
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+"""
+Runs the jpylib tests in the tests package against an in-memory SQLite
+database.  Run every test, or just the ones given as dotted names:
+
+    python runtests.py
+    python runtests.py tests.test_data_import.TransformForeignKeyTest
+"""
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+
+from django.test import TestCase
+from django.test.simple import DjangoTestSuiteRunner, reorder_suite
+
+
+class TestRunner(DjangoTestSuiteRunner):
+    """
+    Finds the tests in the tests package, instead of in each app's tests module
+    """
+
+    def build_suite(self, test_labels, extra_tests=None, **kwargs):
+        loader = unittest.defaultTestLoader
+        if test_labels:
+            suite = loader.loadTestsFromNames(test_labels)
+        else:
+            suite = loader.discover(os.path.join(ROOT, 'tests'), top_level_dir=ROOT)
+        return reorder_suite(suite, (TestCase,))
+
+
+if __name__ == '__main__':
+    failures = TestRunner(verbosity=1, interactive=False, failfast=False).run_tests(sys.argv[1:])
+    sys.exit(bool(failures))
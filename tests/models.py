@@ -0,0 +1,30 @@
+"""
+Models used by the jpylib tests
+"""
+from django.db import models
+
+
+class Author(models.Model):
+    name = models.CharField(max_length=100)
+
+
+class Tag(models.Model):
+    name = models.CharField(max_length=100)
+
+
+class Book(models.Model):
+    key = models.CharField(max_length=20, unique=True)
+    title = models.CharField(max_length=100, blank=True)
+    author = models.ForeignKey(Author, null=True, blank=True)
+    tags = models.ManyToManyField(Tag, blank=True)
+
+
+class Club(models.Model):
+    name = models.CharField(max_length=100)
+    members = models.ManyToManyField(Author, through='Membership')
+
+
+class Membership(models.Model):
+    club = models.ForeignKey(Club)
+    author = models.ForeignKey(Author)
+    role = models.CharField(max_length=20)
@@ -0,0 +1,23 @@
+"""
+Django settings for running the jpylib tests, see runtests.py
+"""
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+}
+
+INSTALLED_APPS = (
+    'django.contrib.contenttypes',
+    'tests',
+)
+
+SECRET_KEY = 'jpylib-tests'
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
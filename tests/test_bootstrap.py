@@ -0,0 +1,28 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from jpylib.django.bootstrap import get_app_modules_cache_path, load_app_modules
+
+
+class AppModulesCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.root, 'cache')
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def test_cache_is_written_to_private_dir(self):
+        load_app_modules(['json'], ['tool'], cache_dir=self.cache_dir)
+
+        self.assertEqual(os.stat(self.cache_dir).st_mode & 0777, 0700)
+        self.assertEqual(os.listdir(self.cache_dir),
+                         [os.path.basename(get_app_modules_cache_path(['json'], self.cache_dir))])
+
+    def test_shared_dir_is_not_used(self):
+        os.mkdir(self.cache_dir)
+        os.chmod(self.cache_dir, 0777)
+        load_app_modules(['json'], ['tool'], cache_dir=self.cache_dir)
+
+        self.assertEqual(os.listdir(self.cache_dir), [])
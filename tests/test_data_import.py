@@ -0,0 +1,179 @@
+import datetime
+
+import mock
+from django.core.exceptions import MultipleObjectsReturned
+from django.db import connections
+from django.test import TestCase
+
+from jpylib.date_parsing import (FACEBOOK_DATETIME_FORMAT, TWITTER_DATETIME_FORMAT,
+                                 parse_date, parse_datetime)
+from jpylib.django.utils.data_import import (BulkImporter, DoNotSetException,
+                                             ForeignKeyCache, import_date,
+                                             import_datetime, import_value)
+
+from .models import Author, Book, Tag
+
+
+class TransformForeignKeyTest(TestCase):
+
+    def setUp(self):
+        self.author = Author.objects.create(name='Ann')
+        self.book = Book.objects.create(key='b1', author=self.author)
+
+    def test_unresolved_fk_is_not_set(self):
+        with self.assertRaises(DoNotSetException):
+            import_value(self.book, '999', 'author')
+        self.assertEqual(self.book.author_id, self.author.pk)
+
+    def test_bulk_import_keeps_existing_fk(self):
+        importer = BulkImporter(Book, key='key').import_rows([{'key': 'b1', 'author': '999'}])
+
+        self.assertEqual(importer.not_set, {'author': 1})
+        self.assertEqual(Book.objects.get(key='b1').author_id, self.author.pk)
+
+
+class BulkImporterTest(TestCase):
+
+    def setUp(self):
+        self.author = Author.objects.create(name='Ann')
+
+    def test_creates_and_updates(self):
+        Book.objects.create(key='b1', title='Old')
+        importer = BulkImporter(Book, key='key').import_rows([
+            {'key': 'b1', 'title': 'New'},
+            {'key': 'b2', 'title': 'Second', 'author': str(self.author.pk)},
+        ])
+
+        self.assertEqual((importer.created, importer.updated), (1, 1))
+        self.assertEqual(Book.objects.get(key='b1').title, 'New')
+        self.assertEqual(Book.objects.get(key='b2').author_id, self.author.pk)
+
+    def test_duplicate_key_in_batch_last_row_wins(self):
+        importer = BulkImporter(Book, key='key').import_rows([
+            {'key': 'b1', 'title': 'First'},
+            {'key': 'b2', 'title': 'Other'},
+            {'key': 'b1', 'title': 'Last'},
+        ])
+
+        self.assertEqual(importer.created, 2)
+        self.assertEqual(Book.objects.filter(key='b1').count(), 1)
+        self.assertEqual(Book.objects.get(key='b1').title, 'Last')
+
+    def test_duplicate_existing_key_updated_once(self):
+        Book.objects.create(key='b1', title='Old')
+        importer = BulkImporter(Book, key='key').import_rows([
+            {'key': 'b1', 'title': 'First'},
+            {'key': 'b1', 'title': 'Last'},
+        ])
+
+        self.assertEqual((importer.created, importer.updated), (0, 1))
+        self.assertEqual(Book.objects.get(key='b1').title, 'Last')
+
+    def test_track_changes_skips_unchanged(self):
+        Book.objects.create(key='b1', title='Same')
+        Book.objects.create(key='b2', title='Old')
+        importer = BulkImporter(Book, key='key', track_changes=True).import_rows([
+            {'key': 'b1', 'title': 'Same'},
+            {'key': 'b2', 'title': 'New'},
+        ])
+
+        self.assertEqual((importer.updated, importer.unchanged), (1, 1))
+        self.assertEqual(Book.objects.get(key='b2').title, 'New')
+
+    def test_dry_run_writes_nothing(self):
+        importer = BulkImporter(Book, key='key', dry_run=True).import_rows([{'key': 'b1'}])
+
+        self.assertEqual(importer.created, 1)
+        self.assertFalse(Book.objects.exists())
+
+    def test_m2m_rows(self):
+        tag = Tag.objects.create(name='t')
+        BulkImporter(Book, key='key').import_rows([{'key': 'b1', 'tags': str(tag.pk)}])
+
+        self.assertEqual(list(Book.objects.get(key='b1').tags.all()), [tag])
+
+    def test_update_values_sql(self):
+        connection = connections['default']
+        books = [Book.objects.create(key='b1'), Book.objects.create(key='b2')]
+        books[0].title, books[1].title = 'One', 'Two'
+        title = Book._meta.get_field('title')
+
+        with mock.patch.object(connection, 'cursor') as cursor:
+            BulkImporter(Book, key='key')._update_values(connection, (title,), books)
+
+        sql, params = cursor.return_value.execute.call_args[0]
+        self.assertEqual(
+            sql,
+            'UPDATE "tests_book" SET "title" = "v"."title" FROM (VALUES '
+            '(%s::integer, %s::varchar(100)), (%s::integer, %s::varchar(100))) '
+            'AS "v" ("id", "title") WHERE "tests_book"."id" = "v"."id"'
+        )
+        self.assertEqual(params, [books[0].pk, 'One', books[1].pk, 'Two'])
+
+    def test_update_groups_rows_on_postgres(self):
+        connection = connections['default']
+        books = [Book.objects.create(key='b1'), Book.objects.create(key='b2'),
+                 Book.objects.create(key='b3')]
+        title, author = Book._meta.get_field('title'), Book._meta.get_field('author')
+        importer = BulkImporter(Book, key='key')
+
+        with mock.patch.object(connection, 'vendor', 'postgresql'), \
+                mock.patch.object(importer, '_update_values') as update_values:
+            importer._update([(books[0], [title]), (books[1], [title]), (books[2], [author])])
+
+        groups = sorted(call[0][1:] for call in update_values.call_args_list)
+        self.assertEqual(groups, [((title,), books[:2]), ((author,), books[2:])])
+
+
+class ForeignKeyCacheTest(TestCase):
+
+    def setUp(self):
+        self.authors = [Author.objects.create(name='Ann'), Author.objects.create(name='Bob')]
+
+    def test_prefetch_is_one_query(self):
+        cache = ForeignKeyCache()
+        ids = [str(author.pk) for author in self.authors]
+
+        with self.assertNumQueries(1):
+            cache.prefetch(Author, 'id', ids + ['999'])
+            self.assertEqual(cache.get(Author, 'id', ids[0]), self.authors[0])
+            self.assertEqual(cache.get(Author, 'id', self.authors[1].pk), self.authors[1])
+            with self.assertRaises(Author.DoesNotExist):
+                cache.get(Author, 'id', '999')
+
+    def test_get_caches_lookup(self):
+        cache = ForeignKeyCache()
+
+        with self.assertNumQueries(1):
+            cache.get(Author, 'name', 'Ann')
+            self.assertEqual(cache.get(Author, 'name', 'Ann'), self.authors[0])
+
+    def test_multiple_matches(self):
+        Author.objects.create(name='Ann')
+
+        with self.assertRaises(MultipleObjectsReturned):
+            ForeignKeyCache().get(Author, 'name', 'Ann')
+
+
+class DateParsingTest(TestCase):
+
+    def test_formats(self):
+        expected = datetime.datetime(2014, 3, 1, 12, 30, 5)
+        self.assertEqual(parse_datetime('2014-03-01T12:30:05'), expected)
+        self.assertEqual(parse_datetime('2014-03-01T12:30:05+0000', FACEBOOK_DATETIME_FORMAT),
+                         expected)
+        self.assertEqual(parse_datetime('Sat Mar 01 12:30:05 +0000 2014',
+                                        TWITTER_DATETIME_FORMAT), expected)
+        self.assertEqual(parse_date('2014-03-01'), datetime.datetime(2014, 3, 1))
+        self.assertEqual(parse_datetime('01/03/2014 12:30:05', '%d/%m/%Y %H:%M:%S'), expected)
+
+    def test_matches_strptime_errors(self):
+        for value in ('2014-13-01T12:30:05', '2014-03-01 12:30:05', 'nope'):
+            with self.assertRaises(ValueError):
+                parse_datetime(value)
+
+    def test_import_helpers(self):
+        self.assertEqual(import_datetime('2014-03-01T12:30:05.000Z'),
+                         datetime.datetime(2014, 3, 1, 12, 30, 5))
+        self.assertEqual(import_datetime(None), datetime.datetime(1970, 1, 1))
+        self.assertEqual(import_date('2014-03-01T12:30:05'), datetime.datetime(2014, 3, 1))
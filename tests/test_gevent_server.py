@@ -0,0 +1,61 @@
+import os
+import unittest
+
+import mock
+
+from jpylib.django.gevent_server import PreforkMaster, WorkerProcess
+
+
+class PreforkMasterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.master = PreforkMaster('127.0.0.1', 0, {}, workers=1)
+        self.old = self.add_worker(100)
+        self.old.ready = True
+
+    def add_worker(self, pid, replaces=None):
+        pipe_r, pipe_w = os.pipe()
+        os.close(pipe_w)
+        self.master.workers[pid] = WorkerProcess(pid, pipe_r, 0, replaces=replaces)
+        return self.master.workers[pid]
+
+    def reap(self, *pids):
+        exits = [(pid, 256) for pid in pids] + [(0, 0)]
+        with mock.patch('os.waitpid', side_effect=exits):
+            self.master.reap_workers()
+
+    def test_replacement_counts_once_old_worker_dies(self):
+        new = self.add_worker(101, replaces=100)
+        self.reap(100)
+
+        self.assertIsNone(new.replaces)
+        with mock.patch.object(self.master, 'spawn_worker') as spawn_worker:
+            self.master.manage_workers()
+        self.assertFalse(spawn_worker.called)
+
+    def test_crashed_replacement_requeues_old_worker(self):
+        self.add_worker(101, replaces=100)
+        self.reap(101)
+
+        self.assertEqual(self.master.restart_queue, [100])
+
+    def test_failed_recycle_is_retried(self):
+        self.master.handle_messages(self.old, 'X')
+        self.assertTrue(self.old.recycling)
+        self.master.restart_queue = []
+        self.add_worker(101, replaces=100)
+        self.reap(101)
+
+        self.assertFalse(self.old.recycling)
+        self.assertEqual(self.master.restart_queue, [100])
+
+    def test_timed_out_replacement_requeues_old_worker(self):
+        new = self.add_worker(101, replaces=100)
+        new.started -= self.master.ready_timeout + 1
+
+        with mock.patch.object(self.master, 'kill'), \
+                mock.patch.object(self.master, 'spawn_worker') as spawn_worker:
+            self.master.manage_workers()
+
+        self.assertTrue(new.retiring)
+        spawn_worker.assert_called_once_with(replaces=100)
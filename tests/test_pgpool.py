@@ -0,0 +1,47 @@
+import time
+
+import mock
+from django.db.backends.postgresql_psycopg2.base import DatabaseWrapper
+from django.test import TestCase
+from psycopg2 import extensions
+
+from jpylib.django.bootstrap.plugins import pgpool_plugin
+
+
+class PooledWrapperTest(TestCase):
+
+    def setUp(self):
+        pgpool_plugin.install()
+        self.pool = pgpool_plugin.pools['pooled'] = pgpool_plugin.ConnectionPool('pooled', max_size=1)
+        self.addCleanup(pgpool_plugin.pools.pop, 'pooled')
+
+        self.wrapper = DatabaseWrapper({'NAME': 'test', 'USER': '', 'PASSWORD': '', 'HOST': '',
+                                        'PORT': '', 'OPTIONS': {}, 'TIME_ZONE': None}, alias='pooled')
+        self.connection = mock.Mock(closed=False)
+        self.connection.get_transaction_status.return_value = extensions.TRANSACTION_STATUS_INTRANS
+
+    def test_checkin_rolls_back(self):
+        self.pool.slots.acquire()
+        self.wrapper.connection = self.connection
+        self.wrapper.close()
+
+        self.assertTrue(self.connection.rollback.called)
+        self.assertEqual([c for c, _ in self.pool.idle], [self.connection])
+
+    def test_connection_in_transaction_block_is_not_pooled(self):
+        self.pool.slots.acquire()
+        self.wrapper.connection = self.connection
+        self.wrapper.enter_transaction_management()
+        self.wrapper.close()
+
+        self.assertTrue(self.connection.close.called)
+        self.assertEqual(self.pool.idle, [])
+        # The slot was freed
+        self.assertTrue(self.pool.slots.acquire(blocking=False))
+
+    def test_checkout_resets_autocommit_mode(self):
+        self.pool.idle.append((self.connection, time.time()))
+        self.wrapper._cursor()
+
+        self.assertIs(self.wrapper.connection, self.connection)
+        self.connection.set_isolation_level.assert_called_once_with(self.wrapper.isolation_level)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import datetime
+import decimal
+import json
+import unittest
+
+from django.core import serializers as django_serializers
+from django.test import TestCase
+
+from jpylib.django.serializers import (SimpleJSONBackend, StdlibJSONBackend,
+                                       _split_bulk_objects, get_json_backend, save_all)
+
+from .models import Author, Book, Club, Tag
+
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+
+def deserialize(objects):
+    return list(django_serializers.deserialize('json', json.dumps(objects)))
+
+
+class SaveAllTest(TestCase):
+
+    def test_bulk_m2m(self):
+        tags = [Tag.objects.create(name='a'), Tag.objects.create(name='b')]
+        objects = deserialize([
+            {'model': 'tests.book', 'pk': 1, 'fields': {'key': 'b1', 'tags': [tags[0].pk, tags[1].pk]}},
+            {'model': 'tests.book', 'pk': 2, 'fields': {'key': 'b2', 'tags': [tags[1].pk]}},
+        ])
+
+        self.assertEqual(save_all(objects), 2)
+        self.assertEqual(set(Book.objects.get(pk=1).tags.all()), set(tags))
+        self.assertEqual(list(Book.objects.get(pk=2).tags.all()), tags[1:])
+
+    def test_custom_through_is_saved_per_object(self):
+        author = Author.objects.create(name='Ann')
+        objects = deserialize([
+            {'model': 'tests.club', 'pk': 1, 'fields': {'name': 'c', 'members': [author.pk]}},
+            {'model': 'tests.club', 'pk': 2, 'fields': {'name': 'd'}},
+        ])
+
+        to_save, to_create = _split_bulk_objects(Club, objects, 'default')
+
+        self.assertEqual(to_save, objects[:1])
+        self.assertEqual(to_create, objects[1:])
+
+
+class JSONBackendTest(TestCase):
+
+    def test_stdlib_is_the_default(self):
+        self.assertIsInstance(get_json_backend(), StdlibJSONBackend)
+
+    @unittest.skipIf(simplejson is None, "simplejson isn't installed")
+    def test_backends_give_the_same_output(self):
+        author = Author.objects.create(name=u'Zoë')
+        Author.objects.create(name='Bob')
+        data = {
+            'author': author,
+            'authors': Author.objects.order_by('pk'),
+            'names': Author.objects.order_by('pk').values_list('name', flat=True),
+            'datetime': datetime.datetime(2014, 1, 2, 3, 4, 5, 678901),
+            'date': datetime.date(2014, 1, 2),
+            'time': datetime.time(3, 4, 5, 678901),
+            'decimal': decimal.Decimal('1.10'),
+            'floats': [0.1, 1e20, 1.0 / 3],
+            'text': u'caf\xe9 \u2603 </script>',
+        }
+
+        self.assertEqual(SimpleJSONBackend().dumps(data), StdlibJSONBackend().dumps(data))
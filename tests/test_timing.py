@@ -0,0 +1,59 @@
+import os
+import shutil
+import stat
+import tempfile
+
+import mock
+from django.core.signals import request_finished
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from jpylib.django.middleware import timing
+
+
+class TimingStatsTest(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.stats_dir = os.path.join(self.root, 'timings')
+        patcher = mock.patch.object(timing, 'STATS_DIR', self.stats_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.root)
+
+        self.stats = timing.TimingStats()
+        request_timings = timing.RequestTimings()
+        request_timings.end = request_timings.start + 0.02
+        self.stats.record('books', request_timings)
+
+    def test_flush_writes_to_private_dir(self):
+        self.stats.flush(force=True)
+
+        self.assertEqual(stat.S_IMODE(os.stat(self.stats_dir).st_mode), 0700)
+        self.assertEqual(os.listdir(self.stats_dir), ['timings-%s.json' % os.getpid()])
+        self.assertEqual(timing.TimingStats.load_all(self.stats_dir)['books']['count'], 1)
+
+    def test_shared_dir_is_not_used(self):
+        os.mkdir(self.stats_dir)
+        os.chmod(self.stats_dir, 0777)
+        self.stats.flush(force=True)
+
+        self.assertEqual(os.listdir(self.stats_dir), [])
+
+        with open(os.path.join(self.stats_dir, 'timings-1.json'), 'w') as planted:
+            planted.write('{"patterns": {"books": {}}}')
+        self.assertEqual(timing.TimingStats.load_all(self.stats_dir), {})
+
+
+class TimingMiddlewareTest(TestCase):
+
+    def test_finished_request_is_unregistered(self):
+        middleware = timing.TimingMiddleware()
+        middleware.process_request(RequestFactory().get('/books/'))
+        self.assertEqual(len(timing.sampler.active), 1)
+
+        # process_response never ran, ie. another response middleware raised
+        request_finished.send(sender=self.__class__)
+
+        self.assertEqual(timing.sampler.active, {})
+        self.assertIsNone(timing.get_current_timings())
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import json
+
+import gevent
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from jpylib.django.views import AjaxView, BatchAjaxView
+
+
+class CachedView(AjaxView):
+    response_cache_timeout = 60
+    calls = 0
+
+    def get_version_key(self, request, *args, **kwargs):
+        return 1
+
+    def get(self, request, *args, **kwargs):
+        CachedView.calls += 1
+        response = self.ajax_response({'session': request.COOKIES.get('sessionid')})
+        response['X-Custom'] = 'yes'
+        return response
+
+
+class ResponseCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        CachedView.calls = 0
+        self.factory = RequestFactory()
+        self.view = CachedView.as_view()
+
+    def get(self, path='/books/', session='a'):
+        request = self.factory.get(path)
+        request.COOKIES['sessionid'] = session
+        request.META['HTTP_COOKIE'] = 'sessionid=' + session
+        return self.view(request)
+
+    def test_cache_hit_keeps_headers(self):
+        self.get()
+        response = self.get()
+
+        self.assertEqual(CachedView.calls, 1)
+        self.assertEqual(response['X-Custom'], 'yes')
+        self.assertEqual(response['Content-Type'], 'application/json')
+
+    def test_cached_per_session(self):
+        self.get(session='a')
+        response = self.get(session='b')
+
+        self.assertEqual(CachedView.calls, 2)
+        self.assertEqual(json.loads(response.content), {'session': 'b'})
+
+    def test_non_ascii_path(self):
+        self.get(path=u'/books/café/')
+        response = self.get(path=u'/books/café/')
+
+        self.assertEqual(CachedView.calls, 1)
+        self.assertEqual(response.status_code, 200)
+
+
+class LoadConcurrentTest(TestCase):
+
+    def setUp(self):
+        self.view = AjaxView()
+
+    def test_loader_timeout(self):
+        context = self.view.load_concurrent({
+            'slow': (lambda: gevent.sleep(1), 0.01),
+            'fast': lambda: 1,
+        })
+
+        self.assertEqual(context, {'slow': None, 'fast': 1})
+
+    def test_other_timeouts_are_not_caught(self):
+        def loader():
+            raise gevent.Timeout()
+
+        with self.assertRaises(gevent.Timeout):
+            self.view._run_loader('outer', loader, 1)
+
+
+class BatchAjaxViewTest(TestCase):
+
+    def test_loader_error_status(self):
+        view = BatchAjaxView()
+
+        self.assertEqual(view.on_loader_error(0, gevent.Timeout(1))['status'], 504)
+        self.assertEqual(view.on_loader_error(0, ValueError('bad'))['status'], 500)